@@ -4,12 +4,48 @@ import lark
 from lark import Lark
 from lark.indenter import Indenter
 import ctypes
+import concurrent.futures
+import contextvars
+import copy
+import os
+import shutil
+import tempfile
 
 import argparse
 
-if_num = 1
-for_num = 1
-while_num = 1
+
+class CompileState:
+	# everything that changes during one compilation: the numbers that make the labels unique
+	# and the ExecutionProfile guiding the codegen
+	def __init__(self, exec_profile=None):
+		self.if_num = 1
+		self.for_num = 1
+		self.while_num = 1
+		self.profile = exec_profile
+		# symbols known so far and source text, used by the ParseTimeCompiler
+		self.symbol_table = None
+		self.func_sig = None
+		self.tables = None
+		self.source = ''
+		self.deferred = []  # DeferredStatements, they call functions that were not defined yet
+		self.stream = None  # ProgramStream of culevmpile_stream
+
+
+# state of the compilation running in this thread or asyncio task
+compile_state = contextvars.ContextVar('compile_state')
+
+
+class PythonIndenter(Indenter):
+	NL_type = '_NEWLINE'
+	OPEN_PAREN_types = ['LPAR', 'LSQB', 'LBRACE']
+	CLOSE_PAREN_types = ['RPAR', 'RSQB', 'RBRACE']
+	INDENT_type = '_INDENT'
+	DEDENT_type = '_DEDENT'
+	tab_len = 8
+
+	def process(self, stream):
+		# the indentation levels are kept in a copy, so one parser can be used from several threads
+		return Indenter.process(copy.copy(self), stream)
 
 
 class SymbolType(Enum):
@@ -190,7 +226,7 @@ def symbol_type_from_str(size_name):
 def read_builtin_functions(path=None):
 	if path is None:
 		return {}
-	parser = Lark.open('builtin_funcs.g', parser='lalr')
+	parser = Lark.open('builtin_funcs.g', rel_to=__file__, parser='lalr')
 	builtin_tree = parser.parse(open(path).read())
 	func_signatures = {}
 	builtin_addr = 0
@@ -237,15 +273,21 @@ def get_ret_symbol_type(tree_branch):
 	return Symbol(var_type, size)
 
 
-def build_symbol_table(tree_branch, path):
-	symbol_table = {'_global_': {}}
-	stack = [('_global_', tree_branch)]
-	func_signatures = read_builtin_functions(path)
+def get_builtin_symbols(func_signatures):
+	symbols = {}
 	for func in func_signatures:
 		sym = Symbol()
 		sym.sym_type = SymbolType.LABEL
 		sym.address = func_signatures[func].address
-		symbol_table['_global_'][func] = sym
+		symbols[func] = sym
+	return symbols
+
+
+def build_symbol_table(tree_branch, path, instrument=False, builtins=None):
+	# builtins, the signatures already read from path, are copied and not modified
+	stack = [('_global_', tree_branch)]
+	func_signatures = dict(builtins) if builtins is not None else read_builtin_functions(path)
+	symbol_table = {'_global_': get_builtin_symbols(func_signatures)}
 	tables = []
 	m_varAddresses = {'_global_': 0}
 	while len(stack) > 0:
@@ -261,7 +303,7 @@ def build_symbol_table(tree_branch, path):
 					var_type = SymbolType(var_type.value + 3)
 			symbol_table[scope][var_name] = Symbol(var_type, sym_size)
 			symbol_table[scope][var_name].address = m_varAddresses[scope]
-			m_varAddresses[scope] += sym_size
+			m_varAddresses[scope] += symbol_table[scope][var_name].get_size()
 
 		elif tree_item.data == 'funcdef':
 			ret_value = get_ret_symbol_type(tree_item.children[0])
@@ -300,9 +342,20 @@ def build_symbol_table(tree_branch, path):
 				if type(child) == type(tree_branch):
 					stack.append((scope, child))
 
+	if instrument:  # the last global, its size is known once the blocks are counted by instrument_assembly
+		symbol_table['_global_']['_prof_counters'] = Symbol(SymbolType.INT_ARR, 0)
+		symbol_table['_global_']['_prof_counters'].address = m_varAddresses['_global_']
+
 	return symbol_table, func_signatures, tables
 
 
+def get_symbol(symbol_table, scope, var_name):
+	# variables not declared inside a function are looked up in the global scope
+	if var_name in symbol_table[scope]:
+		return symbol_table[scope][var_name]
+	return symbol_table['_global_'][var_name]
+
+
 def write_symbol_table(symbol_table, scope):
 	ret_val = ''
 	for var in symbol_table[scope]:
@@ -321,7 +374,7 @@ def get_value_type(tree_branch, symbol_table, func_sig, scope):
 	var_name = ''
 	if tree_branch.data == 'var':
 		var_name = tree_branch.children[0].value
-		var_type = symbol_table[scope][var_name]
+		var_type = get_symbol(symbol_table, scope, var_name)
 		if len(tree_branch.children) > 1:  # es un array_ind, que habrá que ajustar en compile branch
 			if var_type.sym_size == 0:
 				raise ValueError(var_name + ' in ' + scope + ' is not an array')
@@ -428,6 +481,149 @@ def compile_table(tree_branch):
 	return table_obj, table_st
 
 
+def get_source_position(tree_branch):
+	# '!line,column' lines carry the source position through the assembly, they don't generate code
+	if tree_branch.meta.empty:
+		return ''
+	return '!' + str(tree_branch.meta.line) + ',' + str(tree_branch.meta.column) + '\n'
+
+
+def get_const_condition(tree_branch):
+	# returns True or False when the condition is known at compile time, None otherwise
+	if tree_branch.data == 'const_true':
+		return True
+	elif tree_branch.data == 'const_false':
+		return False
+	elif tree_branch.data == 'number':
+		return float(tree_branch.children[0].value) != 0
+	return None
+
+
+def get_for_range(tree_branch):
+	bounds = []
+	for number in tree_branch.children:
+		if number.children[0].type != 'DECIMAL':
+			raise ValueError('range() only accepts integer values')
+		bounds += [int(number.children[0].value)]
+	if len(bounds) == 1:
+		return 0, bounds[0]
+	return bounds[0], bounds[1]
+
+
+def get_array_element(tree_branch):
+	# (array name, index) of an element access like a[i] or a[3], None for anything else
+	if isinstance(tree_branch, lark.Tree) and tree_branch.data == 'var' and len(tree_branch.children) > 1:
+		return tree_branch.children[0].value, tree_branch.children[1].children[0]
+	return None
+
+
+def get_const_literal(tree_branch, elem_type):
+	# literal of a constant stored in an element of type elem_type, None if it is not a constant of that type
+	if not isinstance(tree_branch, lark.Tree) or tree_branch.data != 'number':
+		return None
+	token = tree_branch.children[0]
+	if elem_type == SymbolType.INT and token.type == 'DECIMAL':
+		return str(token.value)
+	elif elem_type == SymbolType.FLOAT:
+		return str(float(token.value))  # integers are written as floats, as the INT2FLOAT cast would leave them
+	return None
+
+
+def get_element_address(var_name, offset):
+	if offset == 0:
+		return '#' + var_name
+	return '#' + var_name + '+' + str(offset)
+
+
+def get_const_element_store(tree_branch, symbol_table, scope):
+	# (array name, index, literal) of a statement like a[2] = 5 on an int or float array, None for anything else
+	if not isinstance(tree_branch, lark.Tree) or tree_branch.data != 'simple_stmt' or len(tree_branch.children) != 2:
+		return None
+	element = get_array_element(tree_branch.children[0])
+	if element is None or element[1].data != 'number' or element[1].children[0].type != 'DECIMAL':
+		return None
+	var_type = get_symbol(symbol_table, scope, element[0])
+	if var_type.sym_type != SymbolType.INT_ARR and var_type.sym_type != SymbolType.FLOAT_ARR:
+		return None
+	index = int(element[1].children[0].value)
+	value = get_const_literal(tree_branch.children[1], SymbolType(var_type.sym_type.value - 3))
+	if value is None or index < 0 or index >= var_type.get_num_elements():
+		return None
+	return element[0], index, value
+
+
+def join_statements(statements):
+	# statements are (constant element store or None, source position, assembly). Two or more stores of
+	# constants to consecutive elements of one array are written as a single LITERAL4_ARRAY
+	ret_string = ''
+	idx = 0
+	while idx < len(statements):
+		store = statements[idx][0]
+		end = idx + 1
+		while store is not None and end < len(statements) and statements[end][0] is not None and statements[end][0][0] == store[0] and statements[end][0][1] == store[1] + end - idx:
+			end += 1
+		if end - idx > 1:
+			ret_string += statements[idx][1]
+			ret_string += 'LITERAL4_ARRAY ' + ','.join([statement[0][2] for statement in statements[idx:end]]) + '\n'
+			ret_string += 'LITERAL4 ' + get_element_address(store[0], store[1] * 4) + '\n'
+			ret_string += 'STORE4_ARRAY\n'
+		else:
+			ret_string += statements[idx][2]
+		idx = end
+	return ret_string
+
+
+def get_loop_statement(suite):
+	# the only statement of a loop body, None if there are more or it is not a simple statement
+	if len(suite.children) != 1:
+		return None
+	statement = suite.children[0]
+	if isinstance(statement, AsmFragment):
+		return statement.tree
+	return statement if statement.data == 'simple_stmt' else None
+
+
+def compile_bulk_loop(tree_branch, symbol_table, scope, range_start, range_end):
+	# for i in range(a, b): dst[i] = src[i], or dst[i] = constant, is a single array copy or fill.
+	# Returns None when the loop is anything else
+	loop_var = tree_branch.children[0]
+	statement = get_loop_statement(tree_branch.children[2])
+	if statement is None or len(statement.children) != 2 or loop_var.data != 'var' or len(loop_var.children) > 1:
+		return None
+	loop_name = loop_var.children[0].value
+	if get_symbol(symbol_table, scope, loop_name).sym_type != SymbolType.INT or range_start < 0:
+		return None
+	dst = get_array_element(statement.children[0])
+	if dst is None or dst[1].data != 'var' or len(dst[1].children) > 1 or dst[1].children[0].value != loop_name:
+		return None
+	dst_type = get_symbol(symbol_table, scope, dst[0])
+	if dst_type.sym_type.value < 4 or range_end > dst_type.get_num_elements():
+		return None
+	elem_size = dst_type.get_element_size()
+	size_ind = '1' if dst_type.sym_type == SymbolType.CHAR_ARR else '4'
+	ret_string = ''
+	src = get_array_element(statement.children[1])
+	if src is not None:
+		if src[1].data != 'var' or len(src[1].children) > 1 or src[1].children[0].value != loop_name:
+			return None
+		src_type = get_symbol(symbol_table, scope, src[0])
+		if src_type.sym_type != dst_type.sym_type or range_end > src_type.get_num_elements():
+			return None
+		ret_string += 'LITERAL4 ' + str((range_end - range_start) * elem_size) + '\n'
+		ret_string += 'LITERAL4 ' + get_element_address(src[0], range_start * elem_size) + '\n'
+		ret_string += 'LOAD' + size_ind + '_ARRAY\n'
+	else:
+		value = get_const_literal(statement.children[1], SymbolType(dst_type.sym_type.value - 3))
+		if value is None or dst_type.sym_type == SymbolType.CHAR_ARR or range_end - range_start > 32:
+			return None  # the literal grows with every element, longer fills are left as loops
+		ret_string += 'LITERAL4_ARRAY ' + ','.join([value] * (range_end - range_start)) + '\n'
+	ret_string += 'LITERAL4 ' + get_element_address(dst[0], range_start * elem_size) + '\n'
+	ret_string += 'STORE' + size_ind + '_ARRAY\n'
+	ret_string += 'LITERAL4 ' + str(range_end) + '\n'
+	ret_string += compile_branch_var(loop_var, symbol_table, scope)  # the variable is left as the loop would
+	return ret_string
+
+
 def compile_branch_var(tree_branch, symbol_table, scope, load=False):
 	ret_string = ''
 	if tree_branch.data == 'number':
@@ -437,7 +633,7 @@ def compile_branch_var(tree_branch, symbol_table, scope, load=False):
 			ret_string += 'LITERAL4 ' + str(float(tree_branch.children[0].value)) + '\n'
 	elif tree_branch.data == 'var':
 		var_name = tree_branch.children[0].value
-		var_type = symbol_table[scope][var_name]
+		var_type = get_symbol(symbol_table, scope, var_name)
 
 		if (var_type.sym_type.value-3) == 1:
 			size_ind = '1'
@@ -454,6 +650,7 @@ def compile_branch_var(tree_branch, symbol_table, scope, load=False):
 			ret_string += 'LITERAL4 ' + str(var_type.get_element_size()) + '\n'
 
 			ret_string += 'MUL\n'
+			ret_string += 'ADD\n'
 
 			if load:
 				ret_string += 'LOAD' + str(size_ind) + '\n'
@@ -498,9 +695,12 @@ def compile_branch_var(tree_branch, symbol_table, scope, load=False):
 
 
 def compile_branch(tree_branch, symbol_table, func_sig, scope, load=False):
-	global if_num, for_num, while_num
+	state = compile_state.get()
+	profile = state.profile
 
 	ret_string = ''
+	if tree_branch.data == 'simple_stmt' or tree_branch.data == 'return_stmt' or tree_branch.data == 'if_stmt' or tree_branch.data == 'while_stmt' or tree_branch.data == 'for_stmt' or tree_branch.data == 'funcdef':
+		ret_string += get_source_position(tree_branch)
 
 	if tree_branch.data == 'compound_stmt':
 		ret_string += compile_branch(tree_branch.children[0], symbol_table, func_sig, scope)
@@ -528,9 +728,9 @@ def compile_branch(tree_branch, symbol_table, func_sig, scope, load=False):
 			type_dst = get_value_type(tree_branch.children[0], symbol_table, func_sig, scope)
 			type_src = get_value_type(tree_branch.children[2], symbol_table, func_sig, scope)
 			if tree_branch.children[1].data == 'auto_assign':
+				ret_string += compile_branch(tree_branch.children[0], symbol_table, func_sig, scope, True)
 				ret_string += compile_branch(tree_branch.children[2], symbol_table, func_sig, scope, True)
 				ret_string += cast_values(type_src, type_dst)
-				ret_string += compile_branch(tree_branch.children[0], symbol_table, func_sig, scope, True)
 				aassign_val = tree_branch.children[1].children[0].value
 				type_str = ''
 				op_str = ''
@@ -563,13 +763,7 @@ def compile_branch(tree_branch, symbol_table, func_sig, scope, load=False):
 
 		ret_string += 'LITERAL4 @func_end_' + func_name + '\n'
 		ret_string += 'JMP\n'
-		ret_string += '$' + func_name + '\n'
-
-		ret_string += write_symbol_table(symbol_table, func_name)
-
-		ret_string += compile_branch(tree_branch.children[-1], symbol_table, func_sig, func_name)  # compilar suite
-		if tree_branch.children[-1].children[-1].data != 'return_stmt':
-			ret_string += 'RETURN\n'
+		ret_string += compile_function(tree_branch, symbol_table, func_sig)
 		ret_string += '@func_end_' + func_name + '\n'
 		ret_string += '$_global_\n'
 
@@ -594,9 +788,14 @@ def compile_branch(tree_branch, symbol_table, func_sig, scope, load=False):
 
 		elif fun_name not in func_sig:
 			raise ValueError('Function ' + fun_name + ' is not defined\n')
+		elif profile is not None and profile.should_inline(tree_branch, symbol_table, scope):
+			profile.inlining += [(fun_name, scope)]
+			ret_string += compile_branch(profile.function_trees[fun_name].children[-1], symbol_table, func_sig, fun_name)
+			profile.inlining.pop()
 		else:
 			# los parámetros se ponen en la pila en orden inverso porque pasa de una estructura filo a fifo
-			for idx, arg in enumerate(tree_branch.children[1].children[::-1]):
+			call_args = tree_branch.children[1].children if tree_branch.children[1] is not None else []
+			for idx, arg in enumerate(call_args[::-1]):
 				func_arg_type = func_sig[fun_name].param_types[idx]
 				func_call_arg_type = get_value_type(arg, symbol_table, func_sig, scope)
 				ret_string += compile_branch_var(arg, symbol_table, scope, True)
@@ -605,8 +804,18 @@ def compile_branch(tree_branch, symbol_table, func_sig, scope, load=False):
 			ret_string += 'CALL\n'
 
 	elif tree_branch.data == 'if_stmt':
-		local_ifnum = if_num  # como es una variable global, para evitar cambios en la variable en llamadas a compile_branch
-		if_num += 1
+		local_ifnum = state.if_num  # para evitar cambios en la variable en llamadas a compile_branch
+		state.if_num += 1
+		if profile is not None and profile.is_cold_branch(tree_branch):
+			# the hot path skips the body, that is moved out of line to the end of the function
+			ret_string += 'LITERAL4 @if_cold_' + str(local_ifnum) + '\n'
+			ret_string += compile_branch(tree_branch.children[0], symbol_table, func_sig, scope)
+			ret_string += 'JMP_IF\n'
+			ret_string += '@if_stmt_' + str(local_ifnum) + '\n\n'
+			cold_body = compile_branch(tree_branch.children[1], symbol_table, func_sig, scope)
+			profile.cold_code += '@if_cold_' + str(local_ifnum) + '\n' + cold_body
+			profile.cold_code += 'LITERAL4 @if_stmt_' + str(local_ifnum) + '\nJMP\n'
+			return ret_string
 		ret_string += 'LITERAL4 @if_stmt_' + str(local_ifnum) + '\n'
 		ret_string += compile_branch(tree_branch.children[0], symbol_table, func_sig, scope)
 		ret_string += 'NOT\n'
@@ -615,33 +824,57 @@ def compile_branch(tree_branch, symbol_table, func_sig, scope, load=False):
 		ret_string += '@if_stmt_' + str(local_ifnum) + '\n\n'
 
 	elif tree_branch.data == 'while_stmt':
-		local_whilenum = while_num
-		while_num += 1
-		ret_string += '@while_comp_' + str(local_whilenum) + '\n'
-		ret_string += 'LITERAL4 @while_end_' + str(local_whilenum) + '\n'
-		ret_string += compile_branch(tree_branch.children[0], symbol_table, func_sig, scope)
-		ret_string += 'NOT\nJMP_IF\n'
+		# rotated loop: the condition is checked once on entry and then at the bottom of the body,
+		# so every iteration runs a single conditional jump instead of JMP_IF + JMP
+		local_whilenum = state.while_num
+		state.while_num += 1
+		cond_value = get_const_condition(tree_branch.children[0])
+		if cond_value is False:
+			return ret_string  # the body is never executed
+		if cond_value is None:
+			ret_string += 'LITERAL4 @while_end_' + str(local_whilenum) + '\n'
+			ret_string += compile_branch(tree_branch.children[0], symbol_table, func_sig, scope, True)
+			ret_string += 'NOT\nJMP_IF\n'
+		ret_string += '@while_start_' + str(local_whilenum) + '\n'
 		ret_string += compile_branch(tree_branch.children[1], symbol_table, func_sig, scope)
-		ret_string += 'LITERAL4 @while_comp_' + str(local_whilenum) + '\n'
-		ret_string += 'JMP\n'
+		ret_string += get_source_position(tree_branch)  # the bottom test belongs to the while line
+		ret_string += 'LITERAL4 @while_start_' + str(local_whilenum) + '\n'
+		if cond_value is None:
+			ret_string += compile_branch(tree_branch.children[0], symbol_table, func_sig, scope, True)
+			ret_string += 'JMP_IF\n'
+		else:  # while True: single back edge without test
+			ret_string += 'JMP\n'
 		ret_string += '@while_end_' + str(local_whilenum) + '\n'
 
 	elif tree_branch.data == 'for_stmt':
-		local_for = for_num
-		for_num += 1
-		if len(tree_branch.children[1].children) == 1:
-			ret_string += 'LITERAL4 0\n'
-			ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope)
-			ret_string += '@for_start_' + str(local_for) + '\n'
-			ret_string += compile_branch(tree_branch.children[2], symbol_table, func_sig, scope)  # compilar la suite
-			ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope, True)
-			ret_string += 'INC_S\n'
-			ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope)
-			ret_string += 'LITERAL4 @for_start_' + str(local_for) + '\n'  # cargar la dirección de la salida del bloque
-			ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope, True)
-			ret_string += 'LITERAL4 ' + str(tree_branch.children[1].children[0].children[0].value) + '\n'
-			ret_string += 'LESS\n'  # comparo loop var name con el número del final (se podrá resolver mejor de alguna forma, de momento así)
-			ret_string += 'JMP_IF\n'  # compara #loop_var_name y LITERAL4 y salta a @for_start si se cumple
+		local_for = state.for_num
+		state.for_num += 1
+		range_start, range_end = get_for_range(tree_branch.children[1])
+		if range_end <= range_start:
+			return ret_string  # empty range, the entry check is resolved at compile time
+		bulk_code = compile_bulk_loop(tree_branch, symbol_table, scope, range_start, range_end)
+		if bulk_code is not None:
+			return ret_string + bulk_code
+		if profile is not None and profile.should_unroll(tree_branch, range_end - range_start):
+			for loop_value in list(range(range_start, range_end)) + [range_end]:
+				ret_string += 'LITERAL4 ' + str(loop_value) + '\n'
+				ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope)
+				if loop_value < range_end:  # the last store leaves the variable as the loop would
+					ret_string += compile_branch(tree_branch.children[2], symbol_table, func_sig, scope)
+			return ret_string
+		ret_string += 'LITERAL4 ' + str(range_start) + '\n'
+		ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope)
+		ret_string += '@for_start_' + str(local_for) + '\n'
+		ret_string += compile_branch(tree_branch.children[2], symbol_table, func_sig, scope)  # compilar la suite
+		ret_string += get_source_position(tree_branch)
+		ret_string += 'LITERAL4 @for_start_' + str(local_for) + '\n'  # cargar la dirección de la salida del bloque
+		ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope, True)
+		ret_string += 'INC_S\n'
+		ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope)  # the store is followed by the reload
+		ret_string += compile_branch_var(tree_branch.children[0], symbol_table, scope, True)
+		ret_string += 'LITERAL4 ' + str(range_end) + '\n'
+		ret_string += 'LESS\n'  # comparo loop var name con el número del final (se podrá resolver mejor de alguna forma, de momento así)
+		ret_string += 'JMP_IF\n'  # compara #loop_var_name y LITERAL4 y salta a @for_start si se cumple
 
 	elif tree_branch.data == 'arith_expr' or tree_branch.data == 'term':
 		factors = (len(tree_branch.children) - 1) // 2
@@ -690,17 +923,458 @@ def compile_branch(tree_branch, symbol_table, func_sig, scope, load=False):
 		pass
 
 	elif tree_branch.data == 'start' or tree_branch.data == 'input' or tree_branch.data == 'suite':
+		statements = []
 		for tree_child in tree_branch.children:
-			ret_string += compile_branch(tree_child, symbol_table, func_sig, scope)
+			element_store = get_const_element_store(tree_child, symbol_table, scope)
+			statements += [(element_store, get_source_position(tree_child), compile_branch(tree_child, symbol_table, func_sig, scope))]
+		ret_string += join_statements(statements)
+
+	elif tree_branch.data == 'asm':  # compiled beforehand, while parsing
+		ret_string += tree_branch.assembly
 	else:
 		ret_string += compile_branch_var(tree_branch, symbol_table, scope, load)
 	return ret_string
 
 
+def compile_function(tree_branch, symbol_table, func_sig):
+	func_name = tree_branch.children[1].value
+	ret_string = '$' + func_name + '\n'
+	ret_string += write_symbol_table(symbol_table, func_name)
+	profile = compile_state.get().profile
+	if profile is not None:
+		outer_cold_code = profile.cold_code
+		profile.cold_code = ''
+	ret_string += compile_branch(tree_branch.children[-1], symbol_table, func_sig, func_name)  # compilar suite
+	if tree_branch.children[-1].children[-1].data != 'return_stmt':
+		ret_string += 'RETURN\n'
+	if profile is not None:
+		ret_string += profile.cold_code  # out of line blocks, after the last RETURN
+		profile.cold_code = outer_cold_code
+	return ret_string
+
+
+def skip_source_positions(lines, idx):
+	while idx < len(lines) and len(lines[idx]) > 0 and lines[idx][0] == '!':
+		idx += 1
+	return idx
+
+
+def is_var_access(lines, idx, op):
+	# LITERAL #var followed by a LOAD or STORE of the same size, the source positions in between are skipped
+	if idx >= len(lines) or not (lines[idx].startswith('LITERAL1 #') or lines[idx].startswith('LITERAL4 #')):
+		return None
+	next_idx = skip_source_positions(lines, idx + 1)
+	if next_idx < len(lines) and lines[next_idx] in [op + '1', op + '4']:
+		return lines[idx][9:], lines[next_idx][-1], next_idx
+	return None
+
+
+def eliminate_redundant_loads(assembly):
+	# local value numbering on straight line code: top_vars are the variables whose value is on the top
+	# of the stack, so loading any of them again is a CLONE. Every other instruction, label or call
+	# forgets what is known, so stores and calls in between are respected
+	lines = assembly.split('\n')
+	ret_lines = []
+	top_vars = set()
+	idx = 0
+	while idx < len(lines):
+		line = lines[idx]
+		load = is_var_access(lines, idx, 'LOAD')
+		store = is_var_access(lines, idx, 'STORE')
+		if load is not None:
+			var_name, size, load_idx = load
+			if (var_name, size) in top_vars:
+				ret_lines += lines[idx + 1:load_idx] + ['CLONE' + size]
+			else:
+				ret_lines += lines[idx:load_idx + 1]
+				top_vars = {(var_name, size)}
+			idx = load_idx + 1
+		elif store is not None:
+			var_name, size, store_idx = store
+			reload_idx = skip_source_positions(lines, store_idx + 1)
+			reload = is_var_access(lines, reload_idx, 'LOAD')
+			if reload is not None and reload[0] == var_name and reload[1] == size:
+				# the stored value is kept on the stack instead of being loaded again
+				ret_lines += ['CLONE' + size] + lines[idx:store_idx + 1] + lines[store_idx + 1:reload_idx] + lines[reload_idx + 1:reload[2]]
+				top_vars = {(var_name, size)}
+				idx = reload[2] + 1
+			else:
+				ret_lines += lines[idx:store_idx + 1]
+				top_vars = set()
+				idx = store_idx + 1
+		else:
+			if len(line) > 0 and line[0] != '!' and line[0] != '%' and line[0] != '*':
+				top_vars = set()
+			ret_lines += [line]
+			idx += 1
+	return '\n'.join(ret_lines)
+
+
+def get_pure_stack_effect(line):
+	# (popped, pushed) values of an instruction without side effects, None for the rest.
+	# CLONE only reads the top of the stack, so it is counted as a push
+	op = line.split(' ')[0]
+	if op in ['LITERAL1', 'LITERAL4', 'CLONE1', 'CLONE4']:
+		return 0, 1
+	elif op in ['LOAD1', 'LOAD4', 'NOT', 'FNOT', 'INC_S', 'DEC_S', 'CHAR2INT', 'INT2FLOAT', 'FLOAT2INT', 'INT2CHAR']:
+		return 1, 1
+	elif op in ['ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'FADD', 'FSUB', 'FMUL', 'FDIV', 'LESS', 'GREATER', 'EQUALS',
+			'FLESS', 'FGREATER', 'FEQUALS', 'BIT_AND', 'BIT_OR', 'BIT_LS', 'BIT_RS']:
+		return 2, 1
+	return None
+
+
+def get_var_key(symbol_table, scope, var_name):
+	# locals and arguments belong to their function, everything else to the global scope
+	if scope in symbol_table and var_name in symbol_table[scope]:
+		return scope, var_name
+	return '_global_', var_name
+
+
+class BasicBlock:
+	def __init__(self, start):
+		self.start = start  # index of the first line
+		self.end = start  # index past the last line
+		self.events = []  # ('load', var), ('store', var, literal idx, store idx) or ('use', vars) in order
+		self.succ = []  # labels it may jump to
+		self.falls_through = True
+		self.exits = False  # RETURN, globals are read by the caller
+		self.unknown_succ = False  # jump whose target is not pushed inside the block
+		self.live_in = set()
+		self.live_out = set()
+
+
+def build_control_flow_graph(lines, symbol_table, tables, func_reads=None, falls_out=False):
+	# splits the assembly in basic blocks: they start at labels and scope changes and end after
+	# a jump or a RETURN. Only the scalars whose address is used by a LOAD or a STORE right after
+	# it are tracked, the rest may be read through any computed address.
+	# When lines are a chunk of the program, func_reads has what the functions of the chunks before
+	# read, as get_function_reads leaves it, and falls_out means the program goes on after the chunk
+	blocks = [BasicBlock(0)]
+	labels = {}
+	accesses = {}
+	address_taken = set()
+	referenced = set()
+	scope_reads = {}
+	scope_callees = {}
+	callees = {}
+	table_vars = {('_global_', col.name) for table in tables for col in table.columns}
+	scopes = {'_global_'}
+	scope = '_global_'
+	idx = 0
+	while idx < len(lines):
+		line = lines[idx]
+		if len(line) > 0 and (line[0] == '@' or line[0] == '$'):
+			if blocks[-1].start != idx:
+				blocks[-1].end = idx
+				blocks += [BasicBlock(idx)]
+			if line[0] == '@':
+				labels[line[1:]] = len(blocks) - 1
+			else:
+				scope = line[1:]
+				scopes.add(scope)
+			idx += 1
+			continue
+		load = is_var_access(lines, idx, 'LOAD')
+		store = is_var_access(lines, idx, 'STORE')
+		if load is not None or store is not None:
+			var_name, _, op_idx = load if load is not None else store
+			key = get_var_key(symbol_table, scope, var_name[1:])
+			referenced.add(key)
+			if load is not None:
+				accesses[idx] = ('load', key)
+				scope_reads.setdefault(scope, set()).add(key)
+			else:
+				accesses[idx] = ('store', key, idx, op_idx)
+			idx = op_idx + 1
+			continue
+		if line.startswith('LITERAL1 #') or line.startswith('LITERAL4 #'):
+			address_taken.add(get_var_key(symbol_table, scope, line[10:].partition('+')[0]))
+		elif line in ['JMP', 'JMP_IF', 'RETURN']:
+			blocks[-1].end = idx + 1
+			blocks += [BasicBlock(idx + 1)]
+		elif line == 'CALL':
+			callee_idx = idx - 1
+			while callee_idx > 0 and lines[callee_idx][:1] == '!':
+				callee_idx -= 1
+			callees[idx] = lines[callee_idx][10:] if lines[callee_idx].startswith('LITERAL4 #') else None
+			scope_callees.setdefault(scope, []).append(callees[idx])
+		elif line == 'SAVE_TABLE':
+			scope_reads.setdefault(scope, set()).update(table_vars)  # a call to the function saves the columns
+		idx += 1
+	blocks[-1].end = len(lines)
+
+	tracked = set()
+	for key in referenced - address_taken:
+		sym = symbol_table.get(key[0], {}).get(key[1])
+		if sym is not None and sym.sym_type.value < 4:
+			tracked.add(key)
+	tracked_globals = {key for key in tracked if key[0] == '_global_'}
+
+	# globals read by every function, with the ones read by the functions it calls
+	chunk_funcs = [func for func in (symbol_table if func_reads is None else scopes) if func != '_global_']
+	known_reads = {}
+	if func_reads is not None:
+		known_reads = {func: reads & tracked_globals for func, reads in func_reads.items() if reads is not None}
+	func_reads = dict(known_reads)
+	for func in chunk_funcs:
+		func_reads[func] = set()
+	changed = True
+	while changed:
+		changed = False
+		for func in chunk_funcs:
+			reads = scope_reads.get(func, set()) & tracked_globals
+			for callee in scope_callees.get(func, []):
+				reads |= get_call_reads(callee, func_reads, symbol_table, tracked_globals)
+			if reads != func_reads[func]:
+				func_reads[func] = reads
+				changed = True
+
+	for block in blocks:
+		for idx in range(block.start, block.end):
+			line = lines[idx]
+			if idx in accesses:
+				if accesses[idx][1] in tracked:
+					block.events += [accesses[idx]]
+			elif line == 'CALL':
+				block.events += [('use', get_call_reads(callees[idx], func_reads, symbol_table, tracked_globals))]
+			elif line == 'SAVE_TABLE':
+				block.events += [('use', table_vars & tracked)]
+			elif line.startswith('LITERAL4 @'):
+				block.succ += [line[10:]]
+			elif line == 'JMP' or line == 'RETURN':
+				block.falls_through = False
+			if line in ['JMP', 'JMP_IF'] and len(block.succ) == 0:
+				block.unknown_succ = True
+			if line == 'RETURN':
+				block.exits = True
+		if block.exits or block.unknown_succ:
+			block.live_out = set(tracked_globals) if block.exits else set(tracked)
+	if falls_out:
+		blocks[-1].live_out |= tracked_globals
+	return blocks, labels
+
+
+def get_call_reads(callee, func_reads, symbol_table, tracked_globals):
+	# globals a CALL may read: builtins only get their arguments, unknown targets may read any
+	if callee in func_reads:
+		return func_reads[callee]
+	sym = symbol_table['_global_'].get(callee)
+	if sym is not None and sym.sym_type == SymbolType.LABEL and sym.address >= 65536:
+		return set()
+	return tracked_globals
+
+
+def compute_liveness(blocks, labels):
+	# backward dataflow until nothing changes: live_out is the union of the live_in of the
+	# successors and live_in adds the reads of the block to what it does not overwrite
+	changed = True
+	while changed:
+		changed = False
+		for block_idx in range(len(blocks) - 1, -1, -1):
+			block = blocks[block_idx]
+			live = set(block.live_out)
+			if not block.unknown_succ:
+				for label in block.succ:
+					if label in labels:
+						live |= blocks[labels[label]].live_in
+				if block.falls_through and block_idx + 1 < len(blocks):
+					live |= blocks[block_idx + 1].live_in
+			block.live_out = live
+			live = set(live)
+			for event in block.events[::-1]:
+				if event[0] == 'store':
+					live.discard(event[1])
+				elif event[0] == 'load':
+					live.add(event[1])
+				else:
+					live |= event[1]
+			if live != block.live_in:
+				block.live_in = live
+				changed = True
+
+
+def get_store_clone(lines, start, end):
+	# index of the CLONE in CLONE, LITERAL #var, STORE just before end, left by eliminate_redundant_loads
+	idx = end - 1
+	while idx >= start and lines[idx][:1] == '!':
+		idx -= 1
+	if idx < start + 2 or lines[idx] not in ['STORE1', 'STORE4'] or not lines[idx - 1].startswith('LITERAL'):
+		return None
+	if lines[idx - 2] != 'CLONE' + lines[idx][-1]:
+		return None
+	return idx - 2
+
+
+def get_pure_value_lines(lines, start, end):
+	# lines of the pure code that pushes the value found on the stack at end, None if the value comes
+	# from a call, another block or anything else that can not be removed. When the code starts with
+	# a value also kept by CLONE, LITERAL #var, STORE only that CLONE goes
+	need = 1
+	value_lines = []
+	idx = end
+	while need > 0:
+		idx -= 1
+		if idx < start:
+			return None
+		if lines[idx][:1] == '!':
+			continue
+		effect = get_pure_stack_effect(lines[idx])
+		if effect is None and need == 1:
+			clone_idx = get_store_clone(lines, start, idx + 1)
+			if clone_idx is not None:
+				return [clone_idx] + value_lines
+		if effect is None or effect[1] > need:
+			return None
+		need += effect[0] - effect[1]
+		value_lines = [idx] + value_lines
+	return value_lines
+
+
+def eliminate_dead_stores(assembly, symbol_table, tables, func_reads=None, falls_out=False):
+	# a STORE is dead when the variable is written again or never read before any path leaves
+	# the program. The store goes away with the code of its value when it is pure, else the value
+	# is just popped. The scalars that are not read anymore are removed from the memory layout.
+	# With func_reads the assembly is a chunk of the program, see build_control_flow_graph: only the
+	# locals of its functions are removed and func_reads gets what they read
+	while True:
+		lines = assembly.split('\n')
+		blocks, labels = build_control_flow_graph(lines, symbol_table, tables, func_reads, falls_out)
+		compute_liveness(blocks, labels)
+		removed = set()
+		replaced = {}
+		for block in blocks:
+			live = set(block.live_out)
+			for event in block.events[::-1]:
+				if event[0] == 'store':
+					_, key, lit_idx, store_idx = event
+					if key not in live:
+						value_lines = get_pure_value_lines(lines, block.start, lit_idx)
+						if value_lines is not None and removed.isdisjoint(value_lines):
+							removed |= set(value_lines)
+							removed.add(lit_idx)
+						else:
+							replaced[lit_idx] = 'POP' + lines[store_idx][-1]
+						removed.add(store_idx)
+					live.discard(key)
+				elif event[0] == 'load':
+					live.add(event[1])
+				else:
+					live |= event[1]
+		for idx, line in enumerate(lines):
+			if line in ['POP1', 'POP4'] and idx not in removed:  # values popped before are not needed
+				value_lines = get_pure_value_lines(lines, 0, idx)
+				if value_lines is not None and removed.isdisjoint(value_lines):
+					removed |= set(value_lines)
+					removed.add(idx)
+		if len(removed) == 0 and len(replaced) == 0:
+			break
+		assembly = '\n'.join([replaced.get(idx, line) for idx, line in enumerate(lines) if idx not in removed or idx in replaced])
+
+	if func_reads is None:
+		return remove_variables(assembly, symbol_table, get_unused_variables(get_referenced_variables(lines, symbol_table), symbol_table, tables))
+	get_function_reads(lines, symbol_table, tables, func_reads)
+	scopes = {line[1:] for line in lines if line.startswith('$')} - {'_global_'}
+	return remove_variables(assembly, symbol_table, get_unused_variables(get_referenced_variables(lines, symbol_table), symbol_table, tables, scopes))
+
+
+def get_referenced_variables(lines, symbol_table):
+	referenced = set()
+	scope = '_global_'
+	for line in lines:
+		if line.startswith('$'):
+			scope = line[1:]
+		elif line.startswith('LITERAL1 #') or line.startswith('LITERAL4 #'):
+			referenced.add(get_var_key(symbol_table, scope, line[10:].partition('+')[0]))
+	return referenced
+
+
+def get_function_reads(lines, symbol_table, tables, func_reads):
+	# adds to func_reads the globals that every function of lines loads, saves to a table or takes the
+	# address of, with what its callees read. None stands for any global, it calls one that is not known
+	table_vars = {('_global_', col.name) for table in tables for col in table.columns}
+	scope_reads = {}
+	scope_callees = {}
+	scope = '_global_'
+	idx = 0
+	while idx < len(lines):
+		line = lines[idx]
+		if line.startswith('$'):
+			scope = line[1:]
+			scope_reads.setdefault(scope, set())
+			scope_callees.setdefault(scope, [])
+		elif scope != '_global_' and (line.startswith('LITERAL1 #') or line.startswith('LITERAL4 #')):
+			store = is_var_access(lines, idx, 'STORE')
+			if store is not None:
+				idx = store[2]
+			else:
+				scope_reads[scope].add(get_var_key(symbol_table, scope, line[10:].partition('+')[0]))
+		elif scope != '_global_' and line == 'CALL':
+			callee_idx = idx - 1
+			while callee_idx > 0 and lines[callee_idx][:1] == '!':
+				callee_idx -= 1
+			scope_callees[scope] += [lines[callee_idx][10:] if lines[callee_idx].startswith('LITERAL4 #') else None]
+		elif scope != '_global_' and line == 'SAVE_TABLE':
+			scope_reads[scope] |= table_vars
+		idx += 1
+	scope_reads.pop('_global_', None)
+	for func in scope_reads:
+		func_reads[func] = {key for key in scope_reads[func] if key[0] == '_global_'}
+	changed = True
+	while changed:
+		changed = False
+		for func in scope_reads:
+			reads = func_reads[func]
+			for callee in scope_callees[func]:
+				if reads is None:
+					break
+				sym = symbol_table['_global_'].get(callee)
+				if sym is not None and sym.sym_type == SymbolType.LABEL and sym.address >= 65536:
+					continue  # builtins only get their arguments
+				callee_reads = func_reads.get(callee)
+				reads = None if callee_reads is None else reads | callee_reads
+			if reads != func_reads[func]:
+				func_reads[func] = reads
+				changed = True
+
+
+def get_unused_variables(referenced, symbol_table, tables, scopes=None):
+	# scalars of scopes, all of them if None, that no instruction refers to anymore. Arguments and table
+	# columns are kept
+	table_vars = {('_global_', col.name) for table in tables for col in table.columns}
+	unused = []
+	for scope in (symbol_table if scopes is None else scopes):
+		for var_name, sym in symbol_table[scope].items():
+			key = (scope, var_name)
+			if 0 < sym.sym_type.value < 4 and not sym.is_arg and key not in referenced and key not in table_vars:
+				unused += [key]
+	return unused
+
+
+def remove_variables(assembly, symbol_table, variables):
+	# takes the variables out of the memory layout, moving down the ones placed after them,
+	# and out of the declarations of their function
+	for scope, var_name in variables:
+		removed = symbol_table[scope].pop(var_name)
+		for sym in symbol_table[scope].values():
+			if sym.sym_type != SymbolType.LABEL and not sym.is_arg and sym.address > removed.address:
+				sym.address -= removed.get_size()
+	ret_lines = []
+	scope = '_global_'
+	for line in assembly.split('\n'):
+		if line.startswith('$'):
+			scope = line[1:]
+		elif line.startswith('%') and (scope, line[1:].split(',')[0]) in variables:
+			continue
+		ret_lines += [line]
+	return '\n'.join(ret_lines)
+
+
 def compile_value(string_value, scope, symbol_table, elem_size):
 	ret_val = bytes()
-	if string_value[0] == '#':  # its a variable
-		ret_val = bytes(ctypes.c_int32(symbol_table[scope][string_value[1:]].address))
+	if string_value[0] == '#':  # its a variable, maybe with an offset as in #var+8
+		var_name, _, offset = string_value[1:].partition('+')
+		ret_val = bytes(ctypes.c_int32(get_symbol(symbol_table, scope, var_name).address + int(offset or 0)))
 	elif string_value[0] == '@':  # its a label
 		ret_val = bytes(ctypes.c_int32(symbol_table['_global_'][string_value[1:]].address))
 	elif string_value[0] == "'":  # its a char
@@ -728,23 +1402,25 @@ def compile_value(string_value, scope, symbol_table, elem_size):
 	return ret_val
 
 
+def get_instruction_size(line):
+	if len(line) == 0 or line[0] == '$' or line[0] == '%' or line[0] == '*' or line[0] == '@' or line[0] == '!':
+		return 0
+	elif line.startswith('LITERAL4_ARRAY'):
+		return 5 + len(line[15:].split(','))*4
+	elif line.startswith('LITERAL1_ARRAY'):
+		return 5 + len(line[15:].split(','))
+	elif line.startswith('LITERAL4'):
+		return 5
+	elif line.startswith('LITERAL1'):
+		return 2
+	else:
+		return 1
+
+
 def get_var_address(assembly):
 	base_address = 0
 	for line in assembly.split('\n'):
-		if line[0] == '$' or line[0] == '%' or line[0] == '*' or line[0] == '@':
-			pass
-		elif line.startswith('LITERAL4_ARRAY'):
-			base_address += 5
-			base_address += len(line[15:].split(','))*4
-		elif line.startswith('LITERAL1_ARRAY'):
-			base_address += 5
-			base_address += len(line[15:].split(','))
-		elif line.startswith('LITERAL4'):
-			base_address += 5
-		elif line.startswith('LITERAL1'):
-			base_address += 2
-		else:
-			base_address += 1
+		base_address += get_instruction_size(line)
 	return base_address
 
 
@@ -826,7 +1502,8 @@ def get_opcode(strop):
 	return bytes(ctypes.c_char(opcodes[strop]))
 
 
-def compile_asm(assembly, symbol_table, function_signatures, tables, stack_size):
+def compile_asm(assembly, symbol_table, function_signatures, tables, stack_size, line_table=None):
+	# line_table, when given, gets an (address, line, column) entry for every source position
 	out_bytes = bytearray()
 	asm_lines = assembly.split('\n')
 	out_bytes += bytearray([len(tables)])
@@ -836,6 +1513,7 @@ def compile_asm(assembly, symbol_table, function_signatures, tables, stack_size)
 	for table in tables:
 		out_bytes += table.serialization()
 	out_bytes += bytes(ctypes.c_int32(stack_size))
+	header_size = len(out_bytes)
 
 	for line in assembly.split('\n'):
 		if len(line) == 0:
@@ -852,7 +1530,7 @@ def compile_asm(assembly, symbol_table, function_signatures, tables, stack_size)
 				sym.sym_type = SymbolType.LABEL
 				sym.address = num_instructions
 				symbol_table['_global_'][line[1:]] = sym
-		elif line[0] == '%' or line[0] == '*':  # symbol table built
+		elif line[0] == '%' or line[0] == '*' or line[0] == '!':  # symbol table built, source positions
 			pass
 		elif line.startswith('LITERAL4_ARRAY'):
 			num_instructions += 5
@@ -881,38 +1559,794 @@ def compile_asm(assembly, symbol_table, function_signatures, tables, stack_size)
 			pass
 		elif line[0] == '$':
 			scope = line[1:]
-		elif line.startswith('LITERAL4_ARRAY'):
-			out_bytes += get_opcode('LITERAL4_ARRAY')  # TODO recalcular los opcodes
-			vals = line[15:].split(',')
-			out_bytes += bytes(ctypes.c_int32(len(vals)))
-			for val in vals:
-				out_bytes += compile_value(val, scope, symbol_table, 4)
-		elif line.startswith('LITERAL1_ARRAY'):
-			out_bytes += get_opcode('LITERAL1_ARRAY')
-			vals = line[15:].split(',')
-			out_bytes += bytes(ctypes.c_int32(len(vals)))
-			for val in vals:
-				out_bytes += compile_value(val, scope, symbol_table, 1)
-		elif line.startswith('LITERAL4'):
-			out_bytes += get_opcode('LITERAL4')
-			out_bytes += compile_value(line[9:], scope, symbol_table, 4)
-		elif line.startswith('LITERAL1'):
-			out_bytes += get_opcode('LITERAL1')
-			out_bytes += compile_value(line[9:], scope, symbol_table, 1)
+		elif line[0] == '!':
+			if line_table is not None:
+				src_line, src_column = line[1:].split(',')
+				line_table += [(stack_size + len(out_bytes) - header_size, int(src_line), int(src_column))]
+		else:
+			out_bytes += assemble_line(line, scope, symbol_table)
+	return out_bytes
+
+
+def assemble_line(line, scope, symbol_table):
+	out_bytes = bytearray()
+	if line.startswith('LITERAL4_ARRAY'):
+		out_bytes += get_opcode('LITERAL4_ARRAY')  # TODO recalcular los opcodes
+		vals = line[15:].split(',')
+		out_bytes += bytes(ctypes.c_int32(len(vals)))
+		for val in vals:
+			out_bytes += compile_value(val, scope, symbol_table, 4)
+	elif line.startswith('LITERAL1_ARRAY'):
+		out_bytes += get_opcode('LITERAL1_ARRAY')
+		vals = line[15:].split(',')
+		out_bytes += bytes(ctypes.c_int32(len(vals)))
+		for val in vals:
+			out_bytes += compile_value(val, scope, symbol_table, 1)
+	elif line.startswith('LITERAL4'):
+		out_bytes += get_opcode('LITERAL4')
+		out_bytes += compile_value(line[9:], scope, symbol_table, 4)
+	elif line.startswith('LITERAL1'):
+		out_bytes += get_opcode('LITERAL1')
+		out_bytes += compile_value(line[9:], scope, symbol_table, 1)
+	else:
+		out_bytes += get_opcode(line)
+	return out_bytes
+
+
+def write_uleb128(value):
+	out_bytes = bytearray()
+	while True:
+		byte = value & 0x7f
+		value >>= 7
+		if value == 0:
+			out_bytes += bytearray([byte])
+			return out_bytes
+		out_bytes += bytearray([byte | 0x80])
+
+
+def read_uleb128(data, pos):
+	value = 0
+	shift = 0
+	while True:
+		byte = data[pos]
+		pos += 1
+		value |= (byte & 0x7f) << shift
+		shift += 7
+		if byte < 0x80:
+			return value, pos
+
+
+def serialize_line_table(line_table):
+	# 'CLNT', entry count and then, for every entry, the address delta, the zigzag encoded line delta
+	# and the column, all of them as ULEB128. Only the last position of every address is kept
+	entries = []
+	for address, src_line, src_column in line_table:
+		if len(entries) > 0 and entries[-1][0] == address:
+			entries.pop()
+		if len(entries) > 0 and entries[-1][1] == src_line and entries[-1][2] == src_column:
+			continue
+		entries += [(address, src_line, src_column)]
+	out_bytes = bytearray(b'CLNT') + bytes(ctypes.c_int32(len(entries)))
+	last_address = 0
+	last_line = 0
+	for address, src_line, src_column in entries:
+		line_delta = src_line - last_line
+		out_bytes += write_uleb128(address - last_address)
+		out_bytes += write_uleb128(line_delta * 2 if line_delta >= 0 else -line_delta * 2 - 1)
+		out_bytes += write_uleb128(src_column)
+		last_address = address
+		last_line = src_line
+	return out_bytes
+
+
+def read_line_table(data):
+	if data[0:4] != b'CLNT':
+		raise ValueError('Not a line table')
+	num_entries = int.from_bytes(data[4:8], 'little')
+	pos = 8
+	line_table = []
+	address = 0
+	src_line = 0
+	for idx in range(num_entries):
+		address_delta, pos = read_uleb128(data, pos)
+		line_delta, pos = read_uleb128(data, pos)
+		src_column, pos = read_uleb128(data, pos)
+		address += address_delta
+		src_line += line_delta // 2 if line_delta % 2 == 0 else -(line_delta + 1) // 2
+		line_table += [(address, src_line, src_column)]
+	return line_table
+
+
+def get_source_line(line_table, address):
+	# line of the last entry at or before the address, 0 if there is none
+	src_line = 0
+	for entry_address, entry_line, entry_column in line_table:
+		if entry_address > address:
+			break
+		src_line = entry_line
+	return src_line
+
+
+class ExecutionProfile:
+	# execution counts per source line, as written by --profile-report, and the decisions taken with them
+	def __init__(self, line_hits):
+		self.line_hits = line_hits
+		self.max_hits = max(line_hits.values()) if len(line_hits) > 0 else 0
+		self.function_trees = {}
+		self.inlining = []  # (function, scope it is called from) of the bodies being inlined
+		self.cold_code = ''
+		self.changes = []
+		self.saved_instructions = 0
+
+	def get_hits(self, src_line):
+		# lines inside a block have no counter, they take the one of the block leader before them
+		hits = 0
+		for profiled_line in sorted(self.line_hits):
+			if profiled_line > src_line:
+				break
+			hits = self.line_hits[profiled_line]
+		return hits
+
+	def is_hot(self, src_line):
+		return self.max_hits > 0 and self.get_hits(src_line) * 10 >= self.max_hits
+
+	def add_change(self, tree_branch, change, saved_instructions):
+		change = 'Line ' + str(tree_branch.meta.line) + ': ' + change
+		if change not in self.changes:  # inlined bodies are compiled more than once, the profile hits are the same
+			self.changes += [change]
+			self.saved_instructions += saved_instructions
+
+	def is_cold_branch(self, tree_branch):
+		if_hits = self.get_hits(tree_branch.meta.line)
+		body_hits = self.get_hits(tree_branch.children[1].children[0].meta.line)
+		if not self.is_hot(tree_branch.meta.line) or body_hits * 10 > if_hits:
+			return False
+		# the skip path saves the NOT, the body pays a jump back
+		self.add_change(tree_branch, 'if body moved out of line', (if_hits - body_hits) - 2 * body_hits)
+		return True
+
+	def should_unroll(self, tree_branch, iterations):
+		body = tree_branch.children[2]
+		if not self.is_hot(body.children[0].meta.line) or iterations > 8:
+			return False
+		if len(list(body.find_data('simple_stmt'))) > 4 or len(list(body.find_pred(lambda t: t.data == 'for_stmt' or t.data == 'while_stmt'))) > 0:
+			return False
+		# every iteration saves the increment and the bottom test, the unrolled code stores the variable once more
+		self.add_change(tree_branch, 'loop unrolled ' + str(iterations) + ' times', self.get_hits(tree_branch.meta.line) * (iterations * 9 - 2))
+		return True
+
+	def should_inline(self, tree_branch, symbol_table, scope):
+		# only void functions without parameters, locals or return statements can be pasted in place.
+		# The body ends up in the code of the outermost caller, where its locals would hide the names it uses
+		fun_name = tree_branch.children[0].children[0].value
+		if fun_name not in self.function_trees or fun_name in [name for name, _ in self.inlining] or not self.is_hot(tree_branch.meta.line):
+			return False
+		funcdef = self.function_trees[fun_name]
+		if len(funcdef.children) > 3 or len(symbol_table[fun_name]) > 0 or funcdef.children[0].children[0].children[0].type != 'VOID':
+			return False
+		if len(list(funcdef.find_data('return_stmt'))) > 0 or len(list(funcdef.find_data('simple_stmt'))) > 8:
+			return False
+		code_scope = self.inlining[0][1] if len(self.inlining) > 0 else scope
+		names = set(funcdef.children[-1].scan_values(lambda value: isinstance(value, lark.Token) and value.type == 'NAME'))
+		if code_scope != '_global_' and not names.isdisjoint(symbol_table[code_scope]):
+			return False
+		self.add_change(tree_branch, 'call to ' + fun_name + ' inlined', self.get_hits(tree_branch.meta.line) * 3)
+		return True
+
+	def report(self):
+		ret_string = 'Profile guided optimization: ' + str(len(self.changes)) + ' changes\n'
+		for change in self.changes:
+			ret_string += change + '\n'
+		ret_string += 'Hot path instructions saved in the profiled run: ' + str(self.saved_instructions) + '\n'
+		return ret_string
+
+
+def read_profile(path):
+	line_hits = {}
+	for line in open(path).read().split('\n'):
+		line = line.split('#')[0].strip()
+		if len(line) == 0:
+			continue
+		src_line, hits = line.split()
+		line_hits[int(src_line)] = int(hits)
+	return ExecutionProfile(line_hits)
+
+
+class BlockCounters:
+	# host side descriptor of an instrumented image: where the counters are and the source of each one
+	def __init__(self):
+		self.address = 0
+		self.blocks = []  # (line, column, kind) of every counter, kind being 'block' or 'function:name'
+
+	def serialization(self):
+		ret_string = 'COUNTERS ' + str(self.address) + ' ' + str(len(self.blocks)) + '\n'
+		for idx, (src_line, src_column, kind) in enumerate(self.blocks):
+			ret_string += str(idx) + ' ' + str(src_line) + ' ' + str(src_column) + ' ' + kind + '\n'
+		return ret_string
+
+
+def read_block_counters(path):
+	counters = BlockCounters()
+	lines = open(path).read().split('\n')
+	counters.address = int(lines[0].split(' ')[1])
+	for line in lines[1:]:
+		if len(line) == 0:
+			continue
+		entry = line.split(' ')
+		counters.blocks += [(int(entry[1]), int(entry[2]), entry[3])]
+	return counters
+
+
+def instrument_assembly(assembly, symbol_table, counters):
+	# adds a counter increment at the entry of the program, every function and every basic block
+	ret_string = ''
+	leader = 'block'
+	src_position = (0, 0)
+	for line in assembly.split('\n'):
+		if len(line) == 0 or line[0] == '%' or line[0] == '*':
+			pass
+		elif line[0] == '!':
+			src_line, src_column = line[1:].split(',')
+			if src_position == (0, 0) and len(counters.blocks) > 0:  # code before the first statement
+				counters.blocks[-1] = (int(src_line), int(src_column), counters.blocks[-1][2])
+			src_position = (int(src_line), int(src_column))
+		elif line[0] == '@':
+			leader = leader or 'block'
+		elif line[0] == '$':
+			if line[1:] != '_global_':
+				leader = 'function:' + line[1:]
+		else:
+			if leader is not None:
+				counter = '#_prof_counters+' + str(len(counters.blocks) * 4)
+				ret_string += 'LITERAL4 ' + counter + '\nLOAD4\nINC_S\nLITERAL4 ' + counter + '\nSTORE4\n'
+				counters.blocks += [(src_position[0], src_position[1], leader)]
+				leader = None
+			if line == 'JMP_IF' or line == 'JMP' or line == 'RETURN':
+				leader = 'block'
+		ret_string += line + '\n'
+	symbol_table['_global_']['_prof_counters'].sym_size = len(counters.blocks) * 4
+	return ret_string[:-1]
+
+
+def get_line_hits(counters, dump, dump_base=0):
+	# hits of every source line from a RAM dump starting at dump_base, the hottest block of the line
+	line_hits = {}
+	for idx, (src_line, src_column, kind) in enumerate(counters.blocks):
+		offset = counters.address - dump_base + idx * 4
+		hits = int.from_bytes(dump[offset:offset + 4], 'little')
+		line_hits[src_line] = max(line_hits.get(src_line, 0), hits)
+	return line_hits
+
+
+def write_line_hits(line_hits):
+	ret_string = '# line hits\n'
+	for src_line in sorted(line_hits):
+		ret_string += str(src_line) + ' ' + str(line_hits[src_line]) + '\n'
+	return ret_string
+
+
+class ObjectSection:
+	def __init__(self, name=''):
+		self.name = name  # function name, or _global_ for the top level code
+		self.code = bytearray()
+		self.labels = {}  # local label -> offset inside the section
+		self.relocations = []  # (offset, symbol) pairs, symbol being '@label' or '#name'
+
+
+class ObjectFile:
+	# relocatable unit: code sections without addresses, plus the symbols defined in the unit
+	def __init__(self):
+		self.tables = []
+		self.globals = {}  # name -> Symbol, in declaration order
+		self.functions = {}  # name -> FunctionSignature
+		self.sections = []
+
+	def serialization(self):
+		ret_string = 'CULEOBJ 1\n'
+		ret_string += 'TABLES ' + str(len(self.tables)) + '\n'
+		for table in self.tables:
+			ret_string += str(table)
+		for name, sym in self.globals.items():
+			ret_string += 'GLOBAL ' + name + ' ' + sym.sym_type.name + ' ' + str(sym.sym_size) + '\n'
+		for name, sig in self.functions.items():
+			ret_string += 'FUNCTION ' + name + ' ' + sig.ret_type.sym_type.name + ' ' + str(sig.ret_type.sym_size)
+			for idx, param in enumerate(sig.param_order):
+				ret_string += ' ' + param + ':' + sig.param_types[idx].sym_type.name + ':' + str(sig.param_types[idx].sym_size)
+			ret_string += '\n'
+		for section in self.sections:
+			ret_string += 'SECTION ' + section.name + '\n'
+			for label, offset in section.labels.items():
+				ret_string += 'LABEL ' + label + ' ' + str(offset) + '\n'
+			for offset, symbol in section.relocations:
+				ret_string += 'RELOC ' + str(offset) + ' ' + symbol + '\n'
+			ret_string += 'CODE ' + section.code.hex() + '\n'
+			ret_string += 'ENDSECTION\n'
+		return ret_string
+
+
+def read_object(path):
+	obj = ObjectFile()
+	lines = open(path).read().split('\n')
+	if lines[0] != 'CULEOBJ 1':
+		raise ValueError(path + ' is not an object file')
+	table = None
+	section = None
+	for line in lines[1:]:
+		if len(line) == 0 or line.startswith('TABLES') or line.startswith('COLUMNS'):
+			continue
+		entry = line.split(' ')
+		if entry[0] == 'TABLE':
+			table = Table()
+			table.name = entry[1]
+		elif entry[0] == 'PERIOD':
+			table.period = int(entry[1])
+		elif entry[0] == 'ENDTABLE':
+			obj.tables += [table]
+			table = None
+		elif table is not None:
+			col = DataColumn()
+			col_format, col.name = line.split(':')
+			col.data_format = TableFormat.Int32 if col_format == 'INT' else TableFormat.Float
+			table.columns += [col]
+		elif entry[0] == 'GLOBAL':
+			obj.globals[entry[1]] = Symbol(SymbolType[entry[2]], int(entry[3]))
+		elif entry[0] == 'FUNCTION':
+			sig = FunctionSignature()
+			sig.ret_type = Symbol(SymbolType[entry[2]], int(entry[3]))
+			for param in entry[4:]:
+				param_name, param_type, param_size = param.split(':')
+				sig.param_order += [param_name]
+				sig.param_types += [Symbol(SymbolType[param_type], int(param_size), True)]
+			obj.functions[entry[1]] = sig
+		elif entry[0] == 'SECTION':
+			section = ObjectSection(entry[1])
+		elif entry[0] == 'LABEL':
+			section.labels[entry[1]] = int(entry[2])
+		elif entry[0] == 'RELOC':
+			section.relocations += [(int(entry[1]), entry[2])]
+		elif entry[0] == 'CODE':
+			section.code = bytearray.fromhex(entry[1])
+		elif entry[0] == 'ENDSECTION':
+			obj.sections += [section]
 		else:
-			out_bytes += get_opcode(line)
+			raise ValueError('Unrecognized entry in ' + path + ': ' + line)
+	return obj
+
+
+def import_objects(symbol_table, func_sig, objects):
+	# makes the functions and globals of other units visible, they are resolved by the linker
+	for obj in objects:
+		for name, sig in obj.functions.items():
+			if name in func_sig:
+				raise ValueError('Function with name \'' + name + '\' redefined')
+			func_sig[name] = sig
+			sym = Symbol()
+			sym.sym_type = SymbolType.LABEL
+			symbol_table['_global_'][name] = sym
+		for name, sym in obj.globals.items():
+			if name in symbol_table['_global_']:
+				raise ValueError('Global with name \'' + name + '\' redefined')
+			symbol_table['_global_'][name] = sym
+
+
+def assemble_section(name, assembly, symbol_table):
+	section = ObjectSection(name)
+	scope = '_global_'
+	for line in assembly.split('\n'):
+		if len(line) == 0 or line[0] == '%' or line[0] == '*' or line[0] == '!':
+			continue
+		if line[0] == '@':
+			section.labels[line[1:]] = len(section.code)
+		elif line[0] == '$':
+			scope = line[1:]
+		elif line.startswith('LITERAL4 @') or line.startswith('LITERAL4 #'):
+			name = line[10:].partition('+')[0]
+			sym = get_symbol(symbol_table, scope, name) if line[9] == '#' else None
+			if sym is not None and (scope != '_global_' and name in symbol_table[scope] or sym.address >= 65536):
+				section.code += assemble_line(line, scope, symbol_table)  # locals and builtins are not relocated
+			else:
+				section.code += get_opcode('LITERAL4')
+				section.relocations += [(len(section.code), line[9:])]
+				section.code += bytes(4)
+		else:
+			section.code += assemble_line(line, scope, symbol_table)
+	return section
+
+
+def compile_section(tree_branch, symbol_table, func_sig):
+	state_token = compile_state.set(CompileState())  # the labels are local to the section
+	try:
+		if tree_branch.data == 'funcdef':
+			func_name = tree_branch.children[1].value
+			return assemble_section(func_name, eliminate_redundant_loads(compile_function(tree_branch, symbol_table, func_sig)), symbol_table)
+		statements = []
+		for tree_child in tree_branch.children:
+			if tree_child.data == 'compound_stmt' and tree_child.children[0].data == 'funcdef':
+				continue  # every function goes to its own section
+			element_store = get_const_element_store(tree_child, symbol_table, '_global_')
+			statements += [(element_store, get_source_position(tree_child), compile_branch(tree_child, symbol_table, func_sig, '_global_'))]
+		return assemble_section('_global_', eliminate_redundant_loads(join_statements(statements)), symbol_table)
+	finally:
+		compile_state.reset(state_token)
+
+
+def culevmpile_object(tree_branch, builtin_path=None, imports=None, jobs=1, builtins=None):
+	symbol_table, function_signatures, tables = build_symbol_table(tree_branch, builtin_path, False, builtins)
+	obj = ObjectFile()
+	obj.tables = tables
+	for name, sym in symbol_table['_global_'].items():
+		if sym.sym_type != SymbolType.LABEL:
+			obj.globals[name] = sym
+	funcdefs = list(tree_branch.find_data('funcdef'))
+	for funcdef in funcdefs:
+		obj.functions[funcdef.children[1].value] = function_signatures[funcdef.children[1].value]
+		sym = Symbol()
+		sym.sym_type = SymbolType.LABEL  # relocated like the imported functions, the linker places the sections
+		symbol_table['_global_'][funcdef.children[1].value] = sym
+	import_objects(symbol_table, function_signatures, imports or [])
+
+	units = funcdefs + [tree_branch.children[0]]  # the function bodies and the top level statements
+	if jobs > 1:
+		with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+			futures = [executor.submit(compile_section, unit, symbol_table, function_signatures) for unit in units]
+			obj.sections = [future.result() for future in futures]
+	else:
+		obj.sections = [compile_section(unit, symbol_table, function_signatures) for unit in units]
+	return obj
+
+
+def link_objects(objects, stack_size):
+	out_bytes = bytearray()
+	tables = []
+	for obj in objects:
+		tables += obj.tables
+	out_bytes += bytearray([len(tables)])
+	for table in tables:
+		out_bytes += table.serialization()
+	out_bytes += bytes(ctypes.c_int32(stack_size))
+
+	# the functions go first, behind a jump to the top level code of every unit
+	func_sections = [section for obj in objects for section in obj.sections if section.name != '_global_']
+	main_sections = [section for obj in objects for section in obj.sections if section.name == '_global_']
+	code_symbols = {}
+	section_addresses = []
+	num_instructions = 6 if len(func_sections) > 0 else 0
+	for section in func_sections + main_sections:
+		if section.name != '_global_':
+			if section.name in code_symbols:
+				raise ValueError('Function with name \'' + section.name + '\' redefined')
+			code_symbols[section.name] = stack_size + num_instructions
+		section_addresses += [stack_size + num_instructions]
+		num_instructions += len(section.code)
+	main_address = stack_size + num_instructions - sum([len(section.code) for section in main_sections])
+	num_instructions += 1  # final NOP
+
+	data_symbols = {}
+	data_address = stack_size + num_instructions
+	for obj in objects:
+		for name, sym in obj.globals.items():
+			if name in data_symbols:
+				raise ValueError('Global with name \'' + name + '\' redefined')
+			data_symbols[name] = data_address
+			data_address += sym.get_size()
+
+	if len(func_sections) > 0:
+		out_bytes += get_opcode('LITERAL4') + bytes(ctypes.c_int32(main_address)) + get_opcode('JMP')
+	for section, address in zip(func_sections + main_sections, section_addresses):
+		code = bytearray(section.code)
+		for offset, symbol in section.relocations:
+			name, _, sym_offset = symbol[1:].partition('+')  # elements of arrays are written as #var+8
+			if symbol[0] == '@' and name in section.labels:
+				sym_address = address + section.labels[name]
+			elif name in code_symbols:
+				sym_address = code_symbols[name]
+			elif name in data_symbols:
+				sym_address = data_symbols[name]
+			else:
+				raise ValueError('Undefined symbol ' + name + ' in section ' + section.name)
+			code[offset:offset + 4] = bytes(ctypes.c_int32(sym_address + int(sym_offset or 0)))
+		out_bytes += code
+	out_bytes += get_opcode('NOP')
 	return out_bytes
 
 
-def culevmpile(tree_branch, builtin_path=None):
-	global if_num, for_num, while_num
-	if_num = 1
-	for_num = 1
-	while_num = 1
-	symbol_table, function_signatures, tables = build_symbol_table(tree_branch, builtin_path)
-	assembly = '$_global_\n' + write_symbol_table(symbol_table, '_global_')
-	assembly += compile_branch(tree_branch, symbol_table, function_signatures, '_global_') + 'NOP\n'
-	bin_out = compile_asm(assembly, symbol_table, function_signatures, tables, 150)
+def get_default_cycles():
+	# rough cost model of the VM dispatch loop, it can be tuned with a cost file
+	cycles = {}
+	for opcode in ['POP1', 'POP4', 'CLONE1', 'CLONE4', 'NOT', 'FNOT', 'INC_S', 'DEC_S', 'CHAR2INT', 'INT2CHAR', 'NOP']:
+		cycles[opcode] = 2
+	for opcode in ['LITERAL1', 'ADD', 'SUB', 'LESS', 'GREATER', 'EQUALS', 'BIT_AND', 'BIT_OR', 'BIT_LS', 'BIT_RS']:
+		cycles[opcode] = 3
+	for opcode in ['LITERAL4', 'LOAD1', 'LOAD4', 'STORE1', 'STORE4', 'JMP', 'JMP_IF', 'JMP_SZ']:
+		cycles[opcode] = 4
+	for opcode in ['MUL', 'FADD', 'FSUB', 'FMUL', 'FLESS', 'FGREATER', 'FEQUALS', 'INT2FLOAT', 'FLOAT2INT']:
+		cycles[opcode] = 6
+	for opcode in ['DIV', 'MOD', 'FDIV', 'CALL', 'RETURN']:
+		cycles[opcode] = 12
+	for opcode in ['LITERAL1_ARRAY', 'LITERAL4_ARRAY', 'LOAD1_ARRAY', 'LOAD4_ARRAY', 'STORE1_ARRAY', 'STORE4_ARRAY', 'ALLOC', 'FREE']:
+		cycles[opcode] = 20
+	for opcode in ['DELAY', 'WAIT_TABLE', 'SAVE_TABLE']:
+		cycles[opcode] = 20
+	return cycles
+
+
+def read_cost_model(path=None, clock_hz=1000000):
+	# each line of the cost file is 'NAME CYCLES', NAME being an opcode or a builtin function.
+	# The cost of delay is given in cycles per millisecond waited, the cycles of a millisecond at
+	# clock_hz unless the file says otherwise
+	costs = get_default_cycles()
+	costs['delay'] = clock_hz / 1000
+	if path is None:
+		return costs
+	for line_num, line in enumerate(open(path).read().split('\n')):
+		line = line.split('#')[0].strip()
+		if len(line) == 0:
+			continue
+		entry = line.split()
+		if len(entry) != 2:
+			raise ValueError('Invalid cost entry in ' + path + ':' + str(line_num + 1))
+		costs[entry[0]] = float(entry[1])
+	return costs
+
+
+def get_asm_cycles(assembly, costs):
+	cycles = 0
+	for line in assembly.split('\n'):
+		if len(line) == 0 or line[0] == '@' or line[0] == '$' or line[0] == '%' or line[0] == '*' or line[0] == '!':
+			continue
+		cycles += costs.get(line.split(' ')[0], 1)
+	return cycles
+
+
+def table_period_seconds(period):
+	if period <= 60:
+		return period
+	elif period <= 119:
+		return (period - 59) * 60
+	return (period - 118) * 3600
+
+
+class PathBudget:
+	def __init__(self, start_line, end_line, cycles, periodic):
+		self.start_line = start_line  # 0 when the path starts at the beginning of the program
+		self.end_line = end_line  # 0 when the path reaches the end of the program
+		self.cycles = cycles
+		self.periodic = periodic  # the path goes from a waitNextMeasure() to the next one
+
+	def __str__(self):
+		start = 'line ' + str(self.start_line) if self.start_line > 0 else 'start'
+		end = 'line ' + str(self.end_line) if self.end_line > 0 else 'end'
+		cycles = 'unbounded' if self.cycles == float('inf') else str(int(self.cycles)) + ' cycles'
+		return 'Path ' + start + ' -> ' + end + ': ' + cycles
+
+
+class WcetEstimator:
+	# walks the tree following the code emitted by compile_branch. The state of the walk is
+	# the worst case of cycles since the last waitNextMeasure() and the line of that call,
+	# or None when the point is not reachable (after a while True)
+	def __init__(self, tree_branch, symbol_table, func_sig, costs):
+		self.symbol_table = symbol_table
+		self.func_sig = func_sig
+		self.costs = costs
+		self.paths = []
+		self.warnings = []
+		self.func_trees = {}
+		self.call_stack = []
+		for funcdef in tree_branch.find_data('funcdef'):
+			self.func_trees[funcdef.children[1].value] = funcdef
+
+	def estimate(self, tree_branch):
+		state = self.walk(tree_branch, (0, 0), '_global_')
+		if state is not None:
+			self.add_path(state[1], 0, state[0])
+		return self.paths
+
+	def warn(self, tree_branch, msg):
+		warning = 'Line ' + str(getattr(tree_branch.meta, 'line', 0)) + ': ' + msg
+		if warning not in self.warnings:
+			self.warnings += [warning]
+
+	def has_wait(self, tree_branch):
+		for funccall in tree_branch.find_data('funccall'):
+			fun_name = funccall.children[0].children[0].value
+			if fun_name == 'waitNextMeasure':
+				return True
+			if fun_name in self.func_trees and fun_name not in self.call_stack:
+				self.call_stack += [fun_name]
+				callee_wait = self.has_wait(self.func_trees[fun_name].children[-1])
+				self.call_stack.pop()
+				if callee_wait:
+					return True
+		return False
+
+	def add_path(self, start_line, end_line, cycles):
+		# the loops are walked twice, so the same path can be found more than once
+		for path in self.paths:
+			if path.start_line == start_line and path.end_line == end_line:
+				path.cycles = max(path.cycles, cycles)
+				return
+		self.paths += [PathBudget(start_line, end_line, cycles, start_line > 0 and end_line > 0)]
+
+	def add_calls(self, tree_branch, state):
+		# builtins and user functions called from a statement, in evaluation order
+		for funccall in tree_branch.iter_subtrees_topdown():
+			if funccall.data != 'funccall':
+				continue
+			if state is None:
+				return None
+			fun_name = funccall.children[0].children[0].value
+			if fun_name == 'waitNextMeasure':
+				line = funccall.meta.line
+				self.add_path(state[1], line, state[0])
+				state = (0, line)
+			elif fun_name == 'delay':
+				ms_value = funccall.children[1].children[0]
+				if ms_value.data == 'number':
+					state = (state[0] + self.costs['delay'] * float(ms_value.children[0].value), state[1])
+				else:
+					self.warn(funccall, 'delay() with a variable argument can not be bounded')
+					state = (float('inf'), state[1])
+			elif fun_name in self.func_trees:
+				if fun_name in self.call_stack:
+					self.warn(funccall, 'recursive call to ' + fun_name + ' can not be bounded')
+					state = (float('inf'), state[1])
+				else:
+					self.call_stack += [fun_name]
+					state = self.walk(self.func_trees[fun_name].children[-1], state, fun_name)
+					self.call_stack.pop()
+			elif fun_name in self.costs:
+				state = (state[0] + self.costs[fun_name], state[1])
+			elif fun_name != 'saveTable':
+				self.warn(funccall, 'no cost given for builtin ' + fun_name)
+		return state
+
+	def walk(self, tree_branch, state, scope):
+		if state is None:
+			return None
+
+		if tree_branch.data == 'start' or tree_branch.data == 'input' or tree_branch.data == 'suite' or tree_branch.data == 'compound_stmt':
+			for tree_child in tree_branch.children:
+				state = self.walk(tree_child, state, scope)
+
+		elif tree_branch.data == 'simple_stmt' or tree_branch.data == 'return_stmt':
+			cycles = get_asm_cycles(compile_branch(tree_branch, self.symbol_table, self.func_sig, scope), self.costs)
+			state = self.add_calls(tree_branch, (state[0] + cycles, state[1]))
+
+		elif tree_branch.data == 'funcdef':
+			state = (state[0] + self.costs['LITERAL4'] + self.costs['JMP'], state[1])  # jump over the body
+
+		elif tree_branch.data == 'if_stmt':
+			cond = tree_branch.children[0]
+			cycles = self.costs['LITERAL4'] + self.costs['NOT'] + self.costs['JMP_IF']
+			cycles += get_asm_cycles(compile_branch(cond, self.symbol_table, self.func_sig, scope), self.costs)
+			state = self.add_calls(cond, (state[0] + cycles, state[1]))
+			then_state = self.walk(tree_branch.children[1], state, scope)
+			state = merge_path_states(state, then_state)
+
+		elif tree_branch.data == 'while_stmt':
+			cond = tree_branch.children[0]
+			cond_value = get_const_condition(cond)
+			if cond_value is False:
+				return state
+			cond_cycles = 0
+			if cond_value is None:
+				cond_cycles = get_asm_cycles(compile_branch(cond, self.symbol_table, self.func_sig, scope, True), self.costs)
+				state = (state[0] + cond_cycles + self.costs['LITERAL4'] + self.costs['NOT'] + self.costs['JMP_IF'], state[1])
+				back_edge = cond_cycles + self.costs['LITERAL4'] + self.costs['JMP_IF']
+			else:
+				back_edge = self.costs['LITERAL4'] + self.costs['JMP']
+			exit_state = state
+			if self.has_wait(tree_branch.children[1]):
+				first_state = self.walk(tree_branch.children[1], state, scope)
+				if first_state is not None:
+					loop_state = self.walk(tree_branch.children[1], (first_state[0] + back_edge, first_state[1]), scope)
+					exit_state = merge_path_states(merge_path_states(exit_state, first_state), loop_state)
+					if exit_state is not None:
+						exit_state = (exit_state[0] + back_edge, exit_state[1])
+			else:
+				self.warn(tree_branch, 'while loop without waitNextMeasure() can not be bounded')
+				exit_state = (float('inf'), state[1])
+			if cond_value is True:
+				return None  # while True never exits
+			state = exit_state
+
+		elif tree_branch.data == 'for_stmt':
+			range_start, range_end = get_for_range(tree_branch.children[1])
+			if range_end <= range_start:
+				return state
+			bulk_code = compile_bulk_loop(tree_branch, self.symbol_table, scope, range_start, range_end)
+			if bulk_code is not None:
+				return (state[0] + get_asm_cycles(bulk_code, self.costs), state[1])
+			loop_var = tree_branch.children[0]
+			init = 'LITERAL4 ' + str(range_start) + '\n' + compile_branch_var(loop_var, self.symbol_table, scope)
+			back_edge = compile_branch_var(loop_var, self.symbol_table, scope, True) + 'INC_S\n'
+			back_edge += compile_branch_var(loop_var, self.symbol_table, scope) + 'LITERAL4 0\n'
+			back_edge += compile_branch_var(loop_var, self.symbol_table, scope, True) + 'LITERAL4 0\nLESS\nJMP_IF\n'
+			back_edge = get_asm_cycles(back_edge, self.costs)
+			state = (state[0] + get_asm_cycles(init, self.costs), state[1])
+			if self.has_wait(tree_branch.children[2]):
+				state = self.walk(tree_branch.children[2], state, scope)
+				if state is not None and range_end - range_start > 1:
+					loop_state = self.walk(tree_branch.children[2], (state[0] + back_edge, state[1]), scope)
+					state = merge_path_states(state, loop_state)
+				if state is not None:
+					state = (state[0] + back_edge, state[1])
+			else:
+				body_state = self.walk(tree_branch.children[2], (0, state[1]), scope)
+				if body_state is None:
+					return None
+				state = (state[0] + (range_end - range_start) * (body_state[0] + back_edge), state[1])
+
+		return state
+
+
+def merge_path_states(state_a, state_b):
+	if state_a is None:
+		return state_b
+	if state_b is None or state_a[0] >= state_b[0]:
+		return state_a
+	return state_b
+
+
+def estimate_wcet(tree_branch, builtin_path=None, cost_path=None, clock_hz=1000000, builtins=None):
+	symbol_table, function_signatures, tables = build_symbol_table(tree_branch, builtin_path, False, builtins)
+	estimator = WcetEstimator(tree_branch, symbol_table, function_signatures, read_cost_model(cost_path, clock_hz))
+	state_token = compile_state.set(CompileState())
+	try:
+		paths = estimator.estimate(tree_branch)
+	finally:
+		compile_state.reset(state_token)
+	return paths, estimator.warnings, tables
+
+
+def wcet_report(paths, warnings, tables, clock_hz):
+	ret_string = 'WCET estimation at ' + str(clock_hz) + ' Hz\n'
+	period = None
+	if len(tables) > 0:
+		period = min([table_period_seconds(table.period) for table in tables])
+		ret_string += 'Table period: ' + str(period) + ' s\n'
+	for path in paths:
+		ret_string += str(path)
+		if path.cycles != float('inf'):
+			ret_string += ' (' + str(round(path.cycles / clock_hz * 1000, 3)) + ' ms)'
+		ret_string += '\n'
+	for path in paths:
+		if path.periodic and period is not None and path.cycles / clock_hz > period:
+			warnings = warnings + [str(path) + ' can overrun the table period of ' + str(period) + ' s']
+	for warning in warnings:
+		ret_string += 'WARNING: ' + warning + '\n'
+	return ret_string
+
+
+def culevmpile(tree_branch, builtin_path=None, line_table=None, counters=None, exec_profile=None, builtins=None, memory_map=None):
+	# counters, a BlockCounters, builds an instrumented image and gets its descriptor.
+	# memory_map, a MemoryMap, gets where the bytes of the image and the variables are
+	symbol_table, function_signatures, tables = build_symbol_table(tree_branch, builtin_path, counters is not None, builtins)
+	if exec_profile is not None:
+		for funcdef in tree_branch.find_data('funcdef'):
+			exec_profile.function_trees[funcdef.children[1].value] = funcdef
+	state_token = compile_state.set(CompileState(exec_profile))
+	try:
+		assembly = compile_branch(tree_branch, symbol_table, function_signatures, '_global_')
+	finally:
+		compile_state.reset(state_token)
+	if exec_profile is not None and len(exec_profile.cold_code) > 0:
+		assembly += 'LITERAL4 @program_end\nJMP\n' + exec_profile.cold_code + '@program_end\n'
+	return assemble_program(assembly, symbol_table, function_signatures, tables, line_table, counters, memory_map)
+
+
+def assemble_program(assembly, symbol_table, function_signatures, tables, line_table=None, counters=None, memory_map=None):
+	# optimizes the assembly of the whole program and builds the image
+	assembly = eliminate_redundant_loads(assembly + 'NOP\n')
+	assembly = eliminate_dead_stores(assembly, symbol_table, tables)
+	if counters is not None:
+		assembly = instrument_assembly(assembly, symbol_table, counters)
+	assembly = '$_global_\n' + write_symbol_table(symbol_table, '_global_') + assembly
+	bin_out = compile_asm(assembly, symbol_table, function_signatures, tables, 150, line_table)
+	if counters is not None:
+		counters.address = symbol_table['_global_']['_prof_counters'].address
+	if memory_map is not None:
+		build_memory_map(memory_map, assembly, symbol_table, tables, 150)
 	#bin_out = ''
 	asm_prefix = 'TABLES ' + str(len(tables)) + '\n'
 	for table in tables:
@@ -921,6 +2355,597 @@ def culevmpile(tree_branch, builtin_path=None):
 	return assembly, bin_out
 
 
+class MemoryMap:
+	# what takes the space of an image. Every entry is (kind, name, address, size):
+	# HEADER and TABLE are at file offsets, the table headers being the Table.serialization;
+	# STACK, FUNCTION, LINE and GLOBAL at VM addresses and LOCAL at offsets inside the function
+	def __init__(self):
+		self.entries = []
+
+	def add(self, kind, name, address, size):
+		self.entries += [(kind, name, address, size)]
+
+	def get_size(self, kinds):
+		return sum([size for kind, _, _, size in self.entries if kind in kinds])
+
+	def get_sizes(self):
+		return {(kind, name): size for kind, name, _, size in self.entries}
+
+	def largest(self, count=10):
+		# functions and locals are left out, their bytes are already in the lines and the stack
+		leaves = [entry for entry in self.entries if entry[0] in ['HEADER', 'TABLE', 'STACK', 'LINE', 'GLOBAL']]
+		return sorted(leaves, key=lambda entry: entry[3], reverse=True)[:count]
+
+	def serialization(self):
+		ret_string = 'MAP ' + str(len(self.entries)) + '\n'
+		for kind, name, address, size in self.entries:
+			ret_string += kind + ' ' + name + ' ' + str(address) + ' ' + str(size) + '\n'
+		return ret_string
+
+	def report(self, previous=None):
+		header_size = self.get_size(['HEADER', 'TABLE'])
+		code_size = self.get_size(['FUNCTION'])
+		ret_string = 'Image: ' + str(header_size + code_size) + ' bytes, ' + str(header_size) + ' of header and '
+		ret_string += str(code_size) + ' of code\n'
+		ret_string += 'RAM: ' + str(self.get_size(['STACK'])) + ' bytes of stack and ' + str(self.get_size(['GLOBAL']))
+		ret_string += ' of globals\n'
+		ret_string += 'Code per function:\n'
+		for kind, name, address, size in self.entries:
+			if kind == 'FUNCTION':
+				ret_string += '  ' + name + ': ' + str(size) + ' bytes at ' + str(address) + '\n'
+		ret_string += 'Largest contributors:\n'
+		for kind, name, address, size in self.largest():
+			ret_string += '  ' + kind + ' ' + name + ': ' + str(size) + ' bytes\n'
+		if previous is not None:
+			ret_string += 'Changes from the previous map:\n'
+			old_sizes = previous.get_sizes()
+			new_sizes = self.get_sizes()
+			for key in list(old_sizes) + [key for key in new_sizes if key not in old_sizes]:
+				old_size = old_sizes.get(key, 0)
+				new_size = new_sizes.get(key, 0)
+				if old_size != new_size:
+					ret_string += '  ' + key[0] + ' ' + key[1] + ': ' + str(old_size) + ' -> ' + str(new_size)
+					ret_string += ' (' + '{:+d}'.format(new_size - old_size) + ')\n'
+			ret_string += '  Total image: ' + '{:+d}'.format(self.get_size(['HEADER', 'TABLE', 'FUNCTION']) - previous.get_size(['HEADER', 'TABLE', 'FUNCTION']))
+			ret_string += ' bytes, globals: ' + '{:+d}'.format(self.get_size(['GLOBAL']) - previous.get_size(['GLOBAL'])) + ' bytes\n'
+		return ret_string
+
+
+def read_memory_map(path):
+	memory_map = MemoryMap()
+	lines = open(path).read().split('\n')
+	if not lines[0].startswith('MAP '):
+		raise ValueError(path + ' is not a memory map')
+	for line in lines[1:]:
+		if len(line) == 0:
+			continue
+		kind, name, address, size = line.split(' ')
+		memory_map.add(kind, name, int(address), int(size))
+	return memory_map
+
+
+def build_memory_map(memory_map, assembly, symbol_table, tables, stack_size):
+	# the assembly and the symbol table as compile_asm left them, with the final addresses
+	memory_map.add('HEADER', 'tables', 0, 1)
+	offset = 1
+	for table in tables:
+		memory_map.add('TABLE', table.name, offset, len(table.serialization()))
+		offset += len(table.serialization())
+	memory_map.add('HEADER', 'stack_size', offset, 4)
+	memory_map.add('STACK', 'stack', 0, stack_size)
+
+	func_code = {}  # name -> [address, size], in the order they appear
+	line_code = {}  # source line -> [first address, size], 0 for the code before any source position
+	scope = '_global_'
+	src_line = 0
+	address = stack_size
+	for line in assembly.split('\n'):
+		if line.startswith('$'):
+			scope = line[1:]
+		elif line.startswith('!'):
+			src_line = int(line[1:].split(',')[0])
+		size = get_instruction_size(line)
+		if size > 0:
+			func_code.setdefault(scope, [address, 0])[1] += size
+			line_code.setdefault(src_line, [address, 0])[1] += size
+			address += size
+	for name, (func_address, size) in func_code.items():
+		memory_map.add('FUNCTION', name, func_address, size)
+	for src_line in sorted(line_code):
+		memory_map.add('LINE', str(src_line), line_code[src_line][0], line_code[src_line][1])
+
+	for scope in symbol_table:
+		for var_name, sym in symbol_table[scope].items():
+			if sym.sym_type == SymbolType.LABEL or sym.is_arg:
+				continue
+			if scope == '_global_':
+				memory_map.add('GLOBAL', var_name, sym.address, sym.get_size())
+			else:
+				memory_map.add('LOCAL', scope + '.' + var_name, sym.address, sym.get_size())
+
+
+class AsmFragment:
+	# assembly that is already compiled, standing for the tree of a statement or a suite. The ParseTimeCompiler
+	# keeps with it what the statement declares and returns
+	def __init__(self, data, assembly='', declarations=None, children=None):
+		self.data = data  # rule of the statement, 'asm' for a suite
+		self.assembly = assembly
+		self.declarations = declarations or []  # (name, Symbol, shadowed Symbol or None) in source order
+		self.returns = []  # types of the values returned inside
+		self.children = children or []  # statements of a suite, compile_function looks at the last one
+		self.element_store = None  # (array name, index, literal) of a constant element store, for join_statements
+		self.position = ''
+		self.tree = None  # element assignments keep their tree, a loop with one of them as body may be lowered
+
+
+class DeferredStatement:
+	# statement of the ParseTimeCompiler that calls a function defined further on. The signature is needed
+	# to check and cast the arguments, so it is compiled by input, in the scope set by its funcdef
+	def __init__(self, tree):
+		self.tree = tree
+		self.scope = None  # '_global_' if no funcdef takes it
+		self.assembly = None
+
+
+def get_unknown_callees(tree_branch, func_sig):
+	return {call.children[0].children[0].value for call in tree_branch.find_data('funccall')} - set(func_sig)
+
+
+def fill_deferred(assembly, deferred):
+	# puts the compiled statements in place of their '&deferredN' lines, an if or while can hold others.
+	# The lines of the statements that are not compiled yet are left
+	lines = assembly.split('\n')
+	for idx, line in enumerate(lines):
+		if line.startswith('&deferred') and deferred[int(line[9:])].assembly is not None:
+			lines[idx] = fill_deferred(deferred[int(line[9:])].assembly, deferred)[:-1]
+	return '\n'.join(lines)
+
+
+def get_visible_symbols(symbol_table):
+	# while parsing, the globals declared so far are in '_visible_', that out of the functions holds nothing else
+	if '_visible_' not in symbol_table:
+		return symbol_table
+	visible = dict(symbol_table)
+	visible['_global_'] = dict(symbol_table['_global_'], **symbol_table['_visible_'])
+	return visible
+
+
+def get_children_position(children):
+	# (line, column) of the first child, the same propagate_positions gives to the tree of the rule
+	for child in children:
+		if isinstance(child, lark.Tree) and not child.meta.empty:
+			return getattr(child.meta, 'container_line', child.meta.line), getattr(child.meta, 'container_column', child.meta.column)
+		elif isinstance(child, lark.Token):
+			return child.line, child.column
+	return None
+
+
+def get_keyword_position(source, children):
+	# the keyword of if, while, for and return is not among the children, it is the word before the first one
+	for child in children:
+		if isinstance(child, lark.Tree) and not child.meta.empty:
+			pos = getattr(child.meta, 'container_start_pos', child.meta.start_pos)
+			break
+		elif isinstance(child, lark.Token):
+			pos = child.start_pos
+			break
+	else:
+		return None
+	while pos > 0 and source[pos - 1] in ' \t':
+		pos -= 1
+	while pos > 0 and (source[pos - 1].isalnum() or source[pos - 1] == '_'):
+		pos -= 1
+	return source.count('\n', 0, pos) + 1, pos - source.rfind('\n', 0, pos)
+
+
+def make_tree(data, children, position):
+	tree = lark.Tree(data, children)
+	if position is not None:
+		tree.meta.line, tree.meta.column = position
+		tree.meta.empty = False
+	return tree
+
+
+class ParseTimeCompiler(lark.Transformer):
+	# transformer for the lalr parser: every statement is compiled with compile_branch as soon as it is
+	# reduced, so only the trees of the expressions of one statement exist at a time. The symbols are
+	# those declared before, in the '_visible_' scope, and they are placed in their function or in the
+	# global scope once it is known where they belong. A statement calling a function that is not defined
+	# yet, further on or the one being defined, is left as a DeferredStatement. With culevmpile_stream the
+	# statements out of the functions, at column 1, go to the ProgramStream as soon as they are reduced
+	def declare(self, name, sym):
+		visible = compile_state.get().symbol_table['_visible_']
+		declaration = (name, sym, visible.get(name))
+		visible[name] = sym
+		return declaration
+
+	def compile_statement(self, statement):
+		if isinstance(statement, AsmFragment):
+			return statement
+		state = compile_state.get()
+		return AsmFragment(statement.data, compile_branch(statement, state.symbol_table, state.func_sig, '_visible_'))
+
+	def stream_statement(self, fragment, position):
+		# input only gets what a streamed statement declares
+		stream = compile_state.get().stream
+		if stream is None or position is None or position[1] != 1:
+			return fragment
+		stream.feed(fragment)
+		return AsmFragment(fragment.data, '', fragment.declarations)
+
+	def compile_deferred(self, final=False):
+		# the deferred statements whose scope and functions are known, all of them at the end
+		state = compile_state.get()
+		symbol_table = get_visible_symbols(state.symbol_table)
+		for statement in state.deferred:
+			if statement.assembly is None and (final or (statement.scope is not None and len(get_unknown_callees(statement.tree, state.func_sig)) == 0)):
+				statement.assembly = compile_branch(statement.tree, symbol_table, state.func_sig, statement.scope or '_global_')
+				statement.tree = None
+
+	def defer(self, tree):
+		# the fragment holds a placeholder line until input compiles the statement
+		state = compile_state.get()
+		state.deferred += [DeferredStatement(tree)]
+		return AsmFragment(tree.data, '&deferred' + str(len(state.deferred) - 1) + '\n')
+
+	def compile_compound(self, data, children):
+		state = compile_state.get()
+		position = get_keyword_position(state.source, children)
+		tree = make_tree(data, children, position)
+		if len(get_unknown_callees(tree, state.func_sig)) > 0:
+			fragment = self.defer(tree)
+		else:
+			fragment = AsmFragment(data, compile_branch(tree, state.symbol_table, state.func_sig, '_visible_'))
+		for child in children:
+			if isinstance(child, AsmFragment):
+				fragment.declarations += child.declarations
+				fragment.returns += child.returns
+		return self.stream_statement(fragment, position)
+
+	def vardef(self, children):
+		var_type = symbol_type_from_str(children[0].children[0].children[0].type)
+		sym_size = 0
+		if len(children) > 2 and isinstance(children[2], lark.Tree) and children[2].data == 'array_ind':
+			sym_size = int(children[2].children[0].children[0].value)*get_symbol_type_size(var_type)
+			var_type = SymbolType(var_type.value + 3)
+		fragment = AsmFragment('vardef', '', [self.declare(children[1].value, Symbol(var_type, sym_size))])
+		return self.stream_statement(fragment, get_children_position(children))
+
+	def params(self, children):
+		return children
+
+	def tabledef(self, children):
+		state = compile_state.get()
+		table_obj, table_st = compile_table(lark.Tree('tabledef', children))
+		state.tables += [table_obj]
+		fragment = AsmFragment('tabledef', '', [self.declare(element, table_st[element]) for element in table_st])
+		return self.stream_statement(fragment, get_keyword_position(state.source, children))
+
+	def simple_stmt(self, children):
+		state = compile_state.get()
+		position = get_children_position(children)
+		tree = make_tree('simple_stmt', children, position)
+		if len(get_unknown_callees(tree, state.func_sig)) > 0:
+			return self.stream_statement(self.defer(tree), position)
+		fragment = AsmFragment('simple_stmt', compile_branch(tree, state.symbol_table, state.func_sig, '_visible_'))
+		fragment.element_store = get_const_element_store(tree, state.symbol_table, '_visible_')
+		fragment.position = get_source_position(tree)
+		if len(children) == 2 and get_array_element(children[0]) is not None:
+			fragment.tree = tree
+		return self.stream_statement(fragment, position)
+
+	def return_stmt(self, children):
+		# the type is checked by funcdef, the function is not known yet. A deferred return is checked by
+		# compile_branch once it is
+		state = compile_state.get()
+		ret_string = ''
+		position = get_keyword_position(state.source, children)
+		if len(children) > 0 and len(get_unknown_callees(children[0], state.func_sig)) > 0:
+			return self.stream_statement(self.defer(make_tree('return_stmt', children, position)), position)
+		if position is not None:
+			ret_string += '!' + str(position[0]) + ',' + str(position[1]) + '\n'
+		ret_type = Symbol(SymbolType.VOID)
+		if len(children) > 0:
+			ret_type = get_value_type(children[0], state.symbol_table, state.func_sig, '_visible_')
+			ret_string += compile_branch(children[0], state.symbol_table, state.func_sig, '_visible_', True)
+		fragment = AsmFragment('return_stmt', ret_string + 'RETURN\n')
+		fragment.returns = [ret_type]
+		return self.stream_statement(fragment, position)
+
+	def if_stmt(self, children):
+		return self.compile_compound('if_stmt', children)
+
+	def while_stmt(self, children):
+		return self.compile_compound('while_stmt', children)
+
+	def for_stmt(self, children):
+		return self.compile_compound('for_stmt', children)
+
+	def compound_stmt(self, children):
+		return children[0]
+
+	def funcdef(self, children):
+		state = compile_state.get()
+		func_name = children[1].value
+		if func_name in state.func_sig:
+			raise ValueError('Function with name \'' + func_name + '\' redefined')
+		params = children[2] if len(children) > 3 else []
+		suite = children[-1]
+		func_sig = FunctionSignature()
+		func_sig.ret_type = get_ret_symbol_type(children[0])
+		for ret_type in suite.returns:
+			if ret_type.sym_type != func_sig.ret_type.sym_type:
+				raise ValueError('Function ' + func_name + ' should return value of type ' + str(ret_type))
+		scope_symbols = {}
+		for param in params:
+			var_name, sym, _ = param.declarations[0]
+			func_sig.param_types += [Symbol(sym.sym_type, sym.sym_size)]
+			func_sig.param_order += [var_name]
+			scope_symbols[var_name] = Symbol(sym.sym_type, sym.sym_size, True)
+		var_address = 0
+		for var_name, sym, _ in suite.declarations:
+			sym.address = var_address
+			var_address += sym.get_size()
+			scope_symbols[var_name] = sym
+		state.func_sig[func_name] = func_sig
+		state.symbol_table[func_name] = scope_symbols
+		position = get_children_position(children)
+		for statement in state.deferred:
+			if statement.scope is None:
+				# the statements reduced since the function header are its body, the ones before are global
+				statement.scope = func_name if statement.tree.meta.line >= position[0] else '_global_'
+
+		# the parameters and locals are not visible after the function
+		visible = state.symbol_table['_visible_']
+		for var_name, _, shadowed in ([param.declarations[0] for param in params] + suite.declarations)[::-1]:
+			if shadowed is None:
+				del visible[var_name]
+			else:
+				visible[var_name] = shadowed
+
+		self.compile_deferred()
+
+		tree = make_tree('funcdef', children, position)
+		fragment = AsmFragment('funcdef', compile_branch(tree, state.symbol_table, state.func_sig, '_global_'))
+		return self.stream_statement(fragment, position)
+
+	def suite(self, children):
+		statements = [self.compile_statement(child) for child in children]
+		fragment = AsmFragment('asm', join_statements([(statement.element_store, statement.position, statement.assembly) for statement in statements]), children=statements)
+		for statement in statements:
+			fragment.declarations += statement.declarations
+			fragment.returns += statement.returns
+		return fragment
+
+	def input(self, children):
+		# what is declared out of the functions is global
+		state = compile_state.get()
+		program = self.suite(children)
+		var_address = 0
+		for var_name, sym, _ in program.declarations:
+			sym.address = var_address
+			var_address += sym.get_size()
+			state.symbol_table['_global_'][var_name] = sym
+		del state.symbol_table['_visible_']
+		if len(state.deferred) > 0:
+			self.compile_deferred(True)
+			program.assembly = fill_deferred(program.assembly, state.deferred)
+		return program
+
+	def start(self, children):
+		return children[0]
+
+
+def get_treeless_parser(grammar_path='grammar.g'):
+	return Lark.open(grammar_path, rel_to=__file__, parser='lalr', postlex=PythonIndenter(), propagate_positions=True, transformer=ParseTimeCompiler())
+
+
+def culevmpile_treeless(parser, text, builtin_path=None, line_table=None, counters=None, builtins=None, memory_map=None):
+	# parser, from get_treeless_parser, compiles the program while parsing it, no parse tree is built.
+	# Profiles, objects and --wcet need the tree and are only available through culevmpile
+	state = CompileState()
+	state.source = text
+	state.func_sig = dict(builtins) if builtins is not None else read_builtin_functions(builtin_path)
+	state.symbol_table = {'_global_': get_builtin_symbols(state.func_sig), '_visible_': {}}
+	state.tables = []
+	state_token = compile_state.set(state)
+	try:
+		program = parser.parse(text)
+	finally:
+		compile_state.reset(state_token)
+	if counters is not None:
+		variables = [sym for sym in state.symbol_table['_global_'].values() if sym.sym_type != SymbolType.LABEL]
+		state.symbol_table['_global_']['_prof_counters'] = Symbol(SymbolType.INT_ARR, 0)
+		state.symbol_table['_global_']['_prof_counters'].address = sum([sym.get_size() for sym in variables])
+	return assemble_program(program.assembly, state.symbol_table, state.func_sig, state.tables, line_table, counters, memory_map)
+
+
+class ProgramStream:
+	# takes the statements out of the functions from the ParseTimeCompiler as they are reduced. Every function
+	# is a chunk, and so is every run of statements between two functions, held until the next funcdef so its
+	# constant element stores are joined. A chunk is optimized on its own, the globals being live at its end,
+	# and written once the functions it calls before their definition are compiled
+	def __init__(self, writer):
+		self.writer = writer  # StreamAssembler or AsmStreamWriter
+		self.statements = []
+		self.chunks = []
+		self.func_reads = {}  # see get_function_reads
+		self.referenced = set()
+
+	def feed(self, fragment):
+		if fragment.data != 'funcdef':
+			self.statements += [fragment]
+			return
+		self.end_statements()
+		self.chunks += [fragment.assembly]
+		self.write_chunks()
+
+	def end_statements(self):
+		assembly = join_statements([(statement.element_store, statement.position, statement.assembly) for statement in self.statements])
+		if len(assembly) > 0:
+			self.chunks += [assembly]
+		self.statements = []
+
+	def write_chunks(self, last=False):
+		state = compile_state.get()
+		while len(self.chunks) > 0:
+			assembly = fill_deferred(self.chunks[0], state.deferred)
+			if '\n&deferred' in '\n' + assembly:
+				self.chunks[0] = assembly
+				return
+			self.chunks.pop(0)
+			falls_out = not last or len(self.chunks) > 0
+			if not falls_out:
+				assembly += 'NOP\n'  # nothing is read after the end of the program
+			symbol_table = get_visible_symbols(state.symbol_table)
+			assembly = eliminate_dead_stores(eliminate_redundant_loads(assembly), symbol_table, state.tables, self.func_reads, falls_out)
+			self.referenced |= get_referenced_variables(assembly.split('\n'), symbol_table)
+			self.writer.feed(assembly)
+
+	def finish(self):
+		# after input, with every statement compiled and the globals in their scope
+		state = compile_state.get()
+		self.end_statements()
+		if len(self.chunks) == 0:
+			self.chunks = ['']
+		self.write_chunks(True)
+		remove_variables('', state.symbol_table, get_unused_variables(self.referenced, state.symbol_table, state.tables, ['_global_']))
+		self.writer.finish(state.tables)
+
+
+class AsmStreamWriter:
+	# the assembly of culevmpile_stream. The code waits in a temporary file until finish() knows the tables
+	# and the globals that are left
+	def __init__(self, out_file, symbol_table):
+		self.out_file = out_file
+		self.symbol_table = symbol_table
+		self.code_file = tempfile.TemporaryFile('w+')
+
+	def feed(self, assembly):
+		self.code_file.write(assembly)
+
+	def finish(self, tables):
+		self.out_file.write('TABLES ' + str(len(tables)) + '\n' + ''.join([str(table) for table in tables]))
+		self.out_file.write('$_global_\n' + write_symbol_table(self.symbol_table, '_global_'))
+		self.code_file.seek(0)
+		shutil.copyfileobj(self.code_file, self.out_file)
+		self.code_file.close()
+
+
+class StreamAssembler:
+	# encodes the assembly as it arrives, into a temporary file that finish() copies after the header. Forward
+	# labels and globals, whose address depends on the size of the program, are written as zeros and patched
+	def __init__(self, out_file, symbol_table, stack_size, line_table=None):
+		self.out_file = out_file
+		self.code_file = tempfile.TemporaryFile()
+		self.symbol_table = symbol_table
+		self.stack_size = stack_size
+		self.line_table = line_table
+		self.labels = {}
+		self.fixups = []  # (position in code_file, symbol)
+		self.scope = '_global_'
+		self.code_size = 0
+
+	def write(self, code):
+		self.code_file.write(code)
+		self.code_size += len(code)
+
+	def feed(self, assembly):
+		for line in assembly.split('\n'):
+			if len(line) == 0 or line[0] == '%' or line[0] == '*':
+				continue
+			if line[0] == '@':
+				self.labels[line[1:]] = self.stack_size + self.code_size
+			elif line[0] == '$':
+				self.scope = line[1:]
+				if self.scope != '_global_':
+					self.labels[self.scope] = self.stack_size + self.code_size
+			elif line[0] == '!':
+				if self.line_table is not None:
+					src_line, src_column = line[1:].split(',')
+					self.line_table += [(self.stack_size + self.code_size, int(src_line), int(src_column))]
+			elif line.startswith('LITERAL4 @') or line.startswith('LITERAL4 #'):
+				name = line[10:].partition('+')[0]
+				is_local = self.scope != '_global_' and name in self.symbol_table[self.scope]
+				is_builtin = not is_local and name in self.symbol_table['_global_'] and self.symbol_table['_global_'][name].address >= 65536
+				if name in self.labels:
+					self.write(get_opcode('LITERAL4') + bytes(ctypes.c_int32(self.labels[name])))
+				elif line[9] == '#' and (is_local or is_builtin):
+					self.write(assemble_line(line, self.scope, self.symbol_table))  # locals and builtins
+				else:  # globals and the functions that are defined further on
+					self.write(get_opcode('LITERAL4'))
+					self.fixups += [(self.code_size, line[9:])]
+					self.write(bytes(4))
+			else:
+				self.write(assemble_line(line, self.scope, self.symbol_table))
+
+	def finish(self, tables):
+		for position, symbol in self.fixups:
+			name, _, offset = symbol[1:].partition('+')
+			if name in self.labels:
+				address = self.labels[name]
+			elif symbol[0] == '#' and name in self.symbol_table['_global_']:
+				address = self.symbol_table['_global_'][name].address + self.stack_size + self.code_size + int(offset or 0)  # globals go after the program
+			else:
+				raise ValueError('Undefined symbol ' + name)
+			self.code_file.seek(position)
+			self.code_file.write(bytes(ctypes.c_int32(address)))
+		header = bytearray([len(tables)])
+		for table in tables:
+			header += table.serialization()
+		header += bytes(ctypes.c_int32(self.stack_size))
+		self.out_file.write(header)
+		self.code_file.seek(0)
+		shutil.copyfileobj(self.code_file, self.out_file)
+		self.code_file.close()
+
+
+def culevmpile_stream(parser, text, out_file, builtin_path=None, assembly=False, line_table=None, builtins=None):
+	# compiles with the parser of get_treeless_parser and writes the binary, or the assembly, to out_file
+	# function by function: no parse tree is built and only the code of the functions that are called before
+	# their definition is held. The image is the one of culevmpile but for the stores that are dead only
+	# across chunks, see ProgramStream
+	state = CompileState()
+	state.source = text
+	state.func_sig = dict(builtins) if builtins is not None else read_builtin_functions(builtin_path)
+	state.symbol_table = {'_global_': get_builtin_symbols(state.func_sig), '_visible_': {}}
+	state.tables = []
+	writer = AsmStreamWriter(out_file, state.symbol_table) if assembly else StreamAssembler(out_file, state.symbol_table, 150, line_table)
+	state.stream = ProgramStream(writer)
+	state_token = compile_state.set(state)
+	try:
+		parser.parse(text)
+		state.stream.finish()
+	finally:
+		compile_state.reset(state_token)
+
+
+class Compiler:
+	# entry point for library callers. The parser and the builtin signatures are shared and only read,
+	# every call keeps its own CompileState, so one Compiler can be used from a thread pool or asyncio
+	def __init__(self, builtin_path='Compiler_VMBuiltin.h', grammar_path='grammar.g'):
+		if not os.path.isabs(builtin_path):
+			builtin_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), builtin_path)
+		self.parser = Lark.open(grammar_path, rel_to=__file__, parser='lalr', postlex=PythonIndenter(), propagate_positions=True)
+		self.treeless_parser = get_treeless_parser(grammar_path)
+		self.builtins = read_builtin_functions(builtin_path)
+
+	def parse(self, text):
+		return self.parser.parse(text)
+
+	def compile(self, text, line_table=None, counters=None, exec_profile=None, memory_map=None):
+		return culevmpile(self.parse(text), None, line_table, counters, exec_profile, self.builtins, memory_map)
+
+	def compile_treeless(self, text, line_table=None, counters=None, memory_map=None):
+		return culevmpile_treeless(self.treeless_parser, text, None, line_table, counters, self.builtins, memory_map)
+
+	def compile_object(self, text, imports=None):
+		return culevmpile_object(self.parse(text), None, imports, 1, self.builtins)
+
+	def compile_stream(self, text, out_file, assembly=False, line_table=None):
+		culevmpile_stream(self.treeless_parser, text, out_file, None, assembly, line_table, self.builtins)
+
+
 if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser(description='Compile FL files to binary')
@@ -928,26 +2953,60 @@ if __name__ == '__main__':
 	parser.add_argument('-o', '--output', help='Output file')
 	parser.add_argument('-s', '--assembly', help='Outputs assembly language instead of the binary file', action='store_true')
 	parser.add_argument('-d', '--debug', help='Outputs debug in stdout', action='store_true')
+	parser.add_argument('--wcet', help='Prints the worst case execution time between waitNextMeasure() calls', action='store_true')
+	parser.add_argument('--costs', help='Cost file for --wcet, with lines like \'SDI12SingleMeasurement 250000\'')
+	parser.add_argument('--clock', help='Cycles per second used by --wcet', type=int, default=1000000)
+	parser.add_argument('-c', '--object', help='Outputs a relocatable object instead of the binary file', action='store_true')
+	parser.add_argument('-l', '--link', help='Objects linked with the input file, or alone if there is no input', nargs='+', default=[])
+	parser.add_argument('-j', '--jobs', help='Processes used to compile the functions of an object', type=int, default=1)
+	parser.add_argument('-g', '--lines', help='Writes the table that maps bytecode addresses to source lines to this file')
+	parser.add_argument('-G', '--embed-lines', help='Appends the line table and its size after the binary', action='store_true')
+	parser.add_argument('--instrument', help='Counts the executions of every basic block, the counter descriptor is written to this file')
+	parser.add_argument('--profile-report', help='Prints the hits per source line from a counter descriptor and a RAM dump', nargs=2, metavar=('DESCRIPTOR', 'DUMP'))
+	parser.add_argument('--dump-base', help='Address of the first byte of the RAM dump', type=int, default=0)
+	parser.add_argument('--stream', help='Compiles while parsing, as --treeless, and writes the output function by function, so the memory used depends on the largest function and not on the program', action='store_true')
+	parser.add_argument('--profile', help='Hits per source line, as printed by --profile-report, used to optimize the hot paths')
+	parser.add_argument('--map', help='Writes where the bytes of the image and the variables are to this file and prints a summary')
+	parser.add_argument('--map-diff', help='Previous map file compared with the new one in the --map summary')
+	parser.add_argument('--treeless', help='Compiles every statement while parsing, without building the parse tree', action='store_true')
 
 	args = parser.parse_args()
 
-	if args.input is None or (args.output is None and (not args.debug)):
+	if args.profile_report is not None:
+		line_hits = get_line_hits(read_block_counters(args.profile_report[0]), open(args.profile_report[1], 'rb').read(), args.dump_base)
+		print(write_line_hits(line_hits), end='')
+		exit(0)
+
+	if (args.input is None and len(args.link) == 0) or (args.output is None and (not args.debug)):
 		print('Error, input and output should be submitted')
 
-	class PythonIndenter(Indenter):
-		NL_type = '_NEWLINE'
-		OPEN_PAREN_types = ['LPAR', 'LSQB', 'LBRACE']
-		CLOSE_PAREN_types = ['RPAR', 'RSQB', 'RBRACE']
-		INDENT_type = '_INDENT'
-		DEDENT_type = '_DEDENT'
-		tab_len = 8
+	link_objs = [read_object(path) for path in args.link]
+	if args.input is None:
+		open(args.output, 'wb').write(link_objects(link_objs, 150))
+		exit(0)
 
+	if args.treeless and (args.object or len(link_objs) > 0 or args.profile is not None or args.wcet):
+		print('Error, --treeless can not be used with objects, --profile or --wcet')
+		exit(1)
+	if args.stream and (args.embed_lines or args.map is not None or args.instrument is not None or args.object or len(link_objs) > 0 or args.profile is not None or args.wcet):
+		print('Error, --stream can not be used with -G, --map, --instrument, objects, --profile or --wcet')
+		exit(1)
 
-	p = Lark.open('grammar.g', parser='lalr', postlex=PythonIndenter(), propagate_positions=True)
+	line_table = []
+	counters = BlockCounters() if args.instrument is not None else None
+	memory_map = MemoryMap() if args.map is not None else None
 
 	text = open(args.input).read()
 	try:
-		tree = p.parse(text)
+		if args.stream:
+			with open(args.output, 'w' if args.assembly else 'wb') as out_file:
+				culevmpile_stream(get_treeless_parser(), text, out_file, 'Compiler_VMBuiltin.h', args.assembly, line_table)
+		elif args.treeless:
+			tree = None
+			asm, binary = culevmpile_treeless(get_treeless_parser(), text, 'Compiler_VMBuiltin.h', line_table, counters, None, memory_map)
+		else:
+			p = Lark.open('grammar.g', parser='lalr', postlex=PythonIndenter(), propagate_positions=True)
+			tree = p.parse(text)
 	except lark.UnexpectedToken as ut:
 		print('[UT]Error on line: ' + str(ut.line))
 		exit(1)
@@ -958,7 +3017,37 @@ if __name__ == '__main__':
 		print('[UI]Error on line: ' + str(ui.line))
 		exit(1)
 
-	asm, binary = culevmpile(tree, 'Compiler_VMBuiltin.h')
+	if args.stream:
+		if args.lines is not None:
+			open(args.lines, 'wb').write(serialize_line_table(line_table))
+		exit(0)
+
+	if args.object or len(link_objs) > 0:
+		obj = culevmpile_object(tree, 'Compiler_VMBuiltin.h', link_objs, args.jobs)
+		asm = obj.serialization()
+		binary = link_objects(link_objs + [obj], 150)
+		args.assembly = args.assembly or args.object
+	else:
+		exec_profile = read_profile(args.profile) if args.profile is not None else None
+		if tree is not None:
+			asm, binary = culevmpile(tree, 'Compiler_VMBuiltin.h', line_table, counters, exec_profile, None, memory_map)
+		if memory_map is not None:
+			previous_map = read_memory_map(args.map_diff) if args.map_diff is not None else None
+			open(args.map, 'w').write(memory_map.serialization())
+			print(memory_map.report(previous_map), end='')
+		if exec_profile is not None:
+			print(exec_profile.report(), end='')
+		if counters is not None:
+			open(args.instrument, 'w').write(counters.serialization())
+		if args.lines is not None:
+			open(args.lines, 'wb').write(serialize_line_table(line_table))
+		if args.embed_lines:
+			line_section = serialize_line_table(line_table)
+			binary += line_section + bytes(ctypes.c_int32(len(line_section)))
+
+	if args.wcet:
+		wcet_paths, wcet_warnings, wcet_tables = estimate_wcet(tree, 'Compiler_VMBuiltin.h', args.costs, args.clock)
+		print(wcet_report(wcet_paths, wcet_warnings, wcet_tables, args.clock), end='')
 
 	if args.debug:
 		print(asm)
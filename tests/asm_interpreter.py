@@ -0,0 +1,191 @@
+import math
+
+from culevmpiler import SymbolType
+
+# runs the assembly text, not the image, so the optimization passes can be checked before addresses are
+# given. Variables are (scope, name, byte offset), every call gets its locals zeroed, and what the program
+# does is the list of events: the builtins it calls, its delays and the rows it saves to the tables
+
+
+class AsmProgram:
+	def __init__(self, assembly):
+		self.code = []  # (scope, instruction)
+		self.labels = {}
+		self.declarations = {'_global_': []}  # (name, is_arg) in declaration order
+		self.columns = []
+		scope = '_global_'
+		lines = assembly.split('\n')
+		idx = 0
+		while idx < len(lines):
+			line = lines[idx]
+			idx += 1
+			if len(line) == 0 or line[0] == '!':
+				continue
+			if line.startswith('COLUMNS '):
+				for column in lines[idx:idx + int(line[8:])]:
+					self.columns += [column.split(':')[1]]
+				idx += int(line[8:])
+			elif line.startswith('TABLES') or line.startswith('TABLE ') or line.startswith('PERIOD') or line == 'ENDTABLE':
+				continue
+			elif line[0] == '$':
+				scope = line[1:]
+				self.declarations.setdefault(scope, [])
+				if scope != '_global_':
+					self.labels[scope] = len(self.code)
+			elif line[0] == '@':
+				self.labels[line[1:]] = len(self.code)
+			elif line[0] == '%' or line[0] == '*':
+				self.declarations[scope] += [(line[1:].split(',')[0], line[0] == '*')]
+			else:
+				self.code += [(scope, line)]
+
+	def get_value(self, scope, literal):
+		if literal[0] == '#':
+			name, _, offset = literal[1:].partition('+')
+			if name in [var_name for var_name, _ in self.declarations[scope]]:
+				return ('var', scope, name, int(offset or 0))
+			if name in self.labels:
+				return ('label', name)
+			return ('var', '_global_', name, int(offset or 0))  # globals, or builtins called by name
+		elif literal[0] == '@':
+			return ('label', literal[1:])
+		elif literal[0] == "'":
+			return ord(literal[1])
+		elif literal.isdigit():
+			return int(literal)  # as compile_value, anything else is a float
+		return float(literal)
+
+
+def run_assembly(assembly, builtins, max_events=50, max_steps=200000, memory=None):
+	# builtins are the FunctionSignatures of Compiler_VMBuiltin.h, their return values count the calls.
+	# memory, if given, is the dict the variables are kept in, so the caller can look at them afterwards
+	program = AsmProgram(assembly)
+	memory = {} if memory is None else memory
+	stack = []
+	calls = []
+	events = []
+	pc = 0
+	steps = 0
+	while pc < len(program.code) and len(events) < max_events:
+		steps += 1
+		if steps > max_steps:
+			raise ValueError('Program does not finish or save a table row in ' + str(max_steps) + ' steps')
+		scope, line = program.code[pc]
+		pc += 1
+		op, _, arg = line.partition(' ')
+		if op == 'LITERAL1' or op == 'LITERAL4':
+			stack += [program.get_value(scope, arg)]
+		elif op == 'LITERAL4_ARRAY':
+			stack += [('array', tuple([program.get_value(scope, value) for value in arg.split(',')]))]
+		elif op == 'LITERAL1_ARRAY':
+			stack += [('array', tuple([ord(char) for char in arg[1:-1]]))]
+		elif op == 'LOAD1' or op == 'LOAD4':
+			address = stack.pop()
+			stack += [memory.get(address[1:], 0)]
+		elif op == 'STORE1' or op == 'STORE4':
+			address = stack.pop()
+			memory[address[1:]] = stack.pop()
+		elif op == 'LOAD1_ARRAY' or op == 'LOAD4_ARRAY':
+			elem_size = 1 if op == 'LOAD1_ARRAY' else 4
+			_, var_scope, name, offset = stack.pop()
+			size = stack.pop()
+			stack += [('array', tuple([memory.get((var_scope, name, offset + idx), 0) for idx in range(0, size, elem_size)]))]
+		elif op == 'STORE1_ARRAY' or op == 'STORE4_ARRAY':
+			elem_size = 1 if op == 'STORE1_ARRAY' else 4
+			_, var_scope, name, offset = stack.pop()
+			for idx, value in enumerate(stack.pop()[1]):
+				memory[(var_scope, name, offset + idx * elem_size)] = value
+		elif op == 'POP1' or op == 'POP4':
+			stack.pop()
+		elif op == 'CLONE1' or op == 'CLONE4':
+			stack += [stack[-1]]
+		elif op in ['ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'BIT_AND', 'BIT_OR', 'BIT_LS', 'BIT_RS', 'LESS', 'GREATER', 'EQUALS',
+				'FADD', 'FSUB', 'FMUL', 'FDIV', 'FLESS', 'FGREATER', 'FEQUALS']:
+			right = stack.pop()
+			left = stack.pop()
+			if isinstance(left, tuple):  # element address, the index is added to the array
+				stack += [left[:3] + (left[3] + right,)]
+				continue
+			if op == 'ADD' or op == 'FADD':
+				result = left + right
+			elif op == 'SUB' or op == 'FSUB':
+				result = left - right
+			elif op == 'MUL' or op == 'FMUL':
+				result = left * right
+			elif op == 'DIV':
+				result = int(left / right)
+			elif op == 'FDIV':
+				result = left / right
+			elif op == 'MOD':
+				result = int(math.fmod(left, right))
+			elif op == 'BIT_AND':
+				result = left & right
+			elif op == 'BIT_OR':
+				result = left | right
+			elif op == 'BIT_LS':
+				result = left << right
+			elif op == 'BIT_RS':
+				result = left >> right
+			elif op == 'LESS' or op == 'FLESS':
+				result = int(left < right)
+			elif op == 'GREATER' or op == 'FGREATER':
+				result = int(left > right)
+			else:
+				result = int(left == right)
+			stack += [result]
+		elif op == 'NOT' or op == 'FNOT':
+			stack += [int(not stack.pop())]
+		elif op == 'INC_S':
+			stack += [stack.pop() + 1]
+		elif op == 'DEC_S':
+			stack += [stack.pop() - 1]
+		elif op == 'INT2FLOAT':
+			stack += [float(stack.pop())]
+		elif op == 'FLOAT2INT':
+			stack += [int(stack.pop())]
+		elif op == 'INT2CHAR':
+			stack += [stack.pop() & 0xff]
+		elif op == 'CHAR2INT':
+			pass
+		elif op == 'JMP':
+			pc = program.labels[stack.pop()[1]]
+		elif op == 'JMP_IF':
+			condition = stack.pop()
+			target = stack.pop()
+			if condition:
+				pc = program.labels[target[1]]
+		elif op == 'CALL':
+			target = stack.pop()
+			if target[0] == 'label':
+				func_name = target[1]
+				for var_name, is_arg in program.declarations[func_name]:
+					for key in [key for key in memory if key[0] == func_name and key[1] == var_name]:
+						del memory[key]
+				for var_name, is_arg in program.declarations[func_name]:
+					if is_arg:
+						memory[(func_name, var_name, 0)] = stack.pop()
+				calls += [pc]
+				pc = program.labels[func_name]
+			else:
+				func_sig = builtins[target[2]]
+				args = tuple([stack.pop() for _ in func_sig.param_types])
+				events += [('CALL', target[2], args)]
+				if func_sig.ret_type.sym_type == SymbolType.FLOAT:
+					stack += [float(len(events))]
+				elif func_sig.ret_type.sym_type != SymbolType.VOID:
+					stack += [len(events)]
+		elif op == 'RETURN':
+			if len(calls) == 0:
+				break
+			pc = calls.pop()
+		elif op == 'DELAY':
+			events += [('DELAY', stack.pop())]
+		elif op == 'WAIT_TABLE':
+			events += [('WAIT_TABLE',)]
+		elif op == 'SAVE_TABLE':
+			events += [('SAVE_TABLE', tuple([memory.get(('_global_', column, 0), 0) for column in program.columns]))]
+		elif op == 'NOP':
+			pass
+		else:
+			raise ValueError('Instruction not supported: ' + line)
+	return events, stack
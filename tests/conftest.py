@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import culevmpiler  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def compiler():
+	return culevmpiler.Compiler()
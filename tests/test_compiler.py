@@ -0,0 +1,15 @@
+import concurrent.futures
+import glob
+import os
+
+PROGRAMS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'programs', '*.fl')))
+
+
+def test_thread_pool_matches_sequential(compiler):
+	# every program several times, the compilations of one Compiler share nothing but the parser
+	texts = [open(path).read() for path in PROGRAMS] * 8
+	sequential = [(compiler.compile(text), compiler.compile_treeless(text)) for text in texts]
+	with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+		futures = [(executor.submit(compiler.compile, text), executor.submit(compiler.compile_treeless, text)) for text in texts]
+		results = [(compiled.result(), treeless.result()) for compiled, treeless in futures]
+	assert results == sequential
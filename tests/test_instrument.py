@@ -0,0 +1,31 @@
+import ctypes
+
+import culevmpiler
+from asm_interpreter import run_assembly
+
+COUNTED_LOOP = '''table t( 1 s ):
+	int: n
+int i
+for i in range(5):
+	n += 1
+	if n > 3:
+		n += 10
+saveTable()
+'''
+
+
+def test_line_hits_from_dump(compiler, tmp_path):
+	counters = culevmpiler.BlockCounters()
+	assembly, _ = compiler.compile(COUNTED_LOOP, None, counters)
+	memory = {}
+	run_assembly(assembly, compiler.builtins, memory=memory)
+
+	# the RAM dump the device would give, starting at the counters
+	dump = bytearray()
+	for idx in range(len(counters.blocks)):
+		dump += bytes(ctypes.c_int32(memory.get(('_global_', '_prof_counters', idx * 4), 0)))
+	descriptor = tmp_path / 'counters.txt'
+	descriptor.write_text(counters.serialization())
+	line_hits = culevmpiler.get_line_hits(culevmpiler.read_block_counters(str(descriptor)), bytes(dump), counters.address)
+	# line 4 has the entry of the loop and its bottom test, the hottest one counts
+	assert line_hits == {4: 5, 5: 5, 7: 2, 8: 1}
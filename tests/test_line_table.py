@@ -0,0 +1,26 @@
+import culevmpiler
+
+FUNCTION_CALLS = '''int x
+int twice(int v):
+	return v * 2
+x = 3
+if x > 2:
+	x = twice(x)
+x = twice(x)
+'''
+
+
+def test_round_trip_keeps_last_position_of_every_address():
+	# repeated positions are dropped, line deltas go back and forth and addresses need several bytes
+	line_table = [(150, 1, 1), (150, 2, 1), (160, 5, 3), (170, 3, 2), (180, 3, 2), (1150, 300, 1), (1151, 1, 9)]
+	serialized = culevmpiler.serialize_line_table(line_table)
+	assert culevmpiler.read_line_table(serialized) == [(150, 2, 1), (160, 5, 3), (170, 3, 2), (1150, 300, 1), (1151, 1, 9)]
+
+
+def test_round_trip_of_compiled_program(compiler):
+	line_table = []
+	_, binary = compiler.compile(FUNCTION_CALLS, line_table)
+	read_table = culevmpiler.read_line_table(culevmpiler.serialize_line_table(line_table))
+	assert sorted({src_line for _, src_line, _ in read_table}) == [2, 3, 4, 5, 6, 7]
+	for address in range(150, 150 + len(binary)):
+		assert culevmpiler.get_source_line(read_table, address) == culevmpiler.get_source_line(line_table, address)
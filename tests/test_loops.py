@@ -0,0 +1,64 @@
+import pytest
+
+from asm_interpreter import run_assembly
+
+# the rotated loops test their condition once on entry and then at the bottom of the body
+TABLE = '''table t( 1 s ):
+	int: n
+	int: k
+'''
+
+
+def run(compiler, text):
+	return run_assembly(compiler.compile(TABLE + text)[0], compiler.builtins)[0]
+
+
+@pytest.mark.parametrize('start', [0, 1, 3])
+def test_while_variable_condition(compiler, start):
+	events = run(compiler, 'n = ' + str(start) + '''
+while n:
+	n -= 1
+	k += 1
+saveTable()
+''')
+	assert events == [('SAVE_TABLE', (0, start))]
+
+
+def test_while_false(compiler):
+	events = run(compiler, '''n = 2
+while False:
+	n = 5
+	k = 1
+saveTable()
+''')
+	assert events == [('SAVE_TABLE', (2, 0))]
+
+
+@pytest.mark.parametrize('loop_range', ['range(4, 4)', 'range(5, 2)', 'range(0)'])
+def test_empty_range(compiler, loop_range):
+	# the body is not run and the loop variable keeps its value
+	events = run(compiler, '''n = 7
+for n in ''' + loop_range + ''':
+	k += 1
+saveTable()
+''')
+	assert events == [('SAVE_TABLE', (7, 0))]
+
+
+def test_range_bounds(compiler):
+	events = run(compiler, '''for n in range(2, 5):
+	k += n
+	saveTable()
+saveTable()
+''')
+	assert events == [('SAVE_TABLE', (2, 2)), ('SAVE_TABLE', (3, 5)), ('SAVE_TABLE', (4, 9)), ('SAVE_TABLE', (5, 9))]
+
+
+def test_loop_variable_after_loop(compiler):
+	# the variable is left at the end of the range, the value that failed the bottom test
+	events = run(compiler, '''for n in range(3):
+	k += 1
+k = n
+saveTable()
+''')
+	assert events == [('SAVE_TABLE', (3, 3))]
@@ -0,0 +1,39 @@
+import culevmpiler
+
+PROGRAM = '''table t( 1 s ):
+	int: n
+	float: f
+int counts[4]
+int add(int v):
+	return v + n
+n = add(2)
+f = n
+saveTable()
+'''
+
+
+def compile_map(compiler, text):
+	memory_map = culevmpiler.MemoryMap()
+	_, binary = compiler.compile(text, None, None, None, memory_map)
+	return memory_map, binary
+
+
+def test_header_and_code_are_the_image(compiler):
+	memory_map, binary = compile_map(compiler, PROGRAM)
+	assert memory_map.get_size(['HEADER', 'TABLE']) + memory_map.get_size(['FUNCTION']) == len(binary)
+	# the lines split the code of the functions
+	assert memory_map.get_size(['LINE']) == memory_map.get_size(['FUNCTION'])
+
+
+def test_map_diff(compiler, tmp_path):
+	old_map, old_binary = compile_map(compiler, PROGRAM)
+	map_path = tmp_path / 'old.map'
+	map_path.write_text(old_map.serialization())
+	new_map, new_binary = compile_map(compiler, PROGRAM + 'n = 7\nsaveTable()\n')
+	report = new_map.report(culevmpiler.read_memory_map(str(map_path)))
+	changes = report[report.index('Changes from the previous map:'):]
+	old_code = old_map.get_sizes()[('FUNCTION', '_global_')]
+	new_code = new_map.get_sizes()[('FUNCTION', '_global_')]
+	assert 'FUNCTION _global_: ' + str(old_code) + ' -> ' + str(new_code) in changes
+	assert 'FUNCTION add' not in changes
+	assert 'Total image: ' + '{:+d}'.format(len(new_binary) - len(old_binary)) + ' bytes, globals: +0 bytes' in changes
@@ -0,0 +1,40 @@
+import ctypes
+
+import pytest
+
+import culevmpiler
+
+# helpers that call each other in the unit they are defined in, as a shared driver does
+DRIVER = '''int g
+void bump(int p):
+	g += p
+void twice(int p):
+	bump(p)
+	bump(p)
+bump(2)
+twice(1)
+'''
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_calls_inside_unit_are_relocated(compiler, jobs):
+	obj = culevmpiler.culevmpile_object(compiler.parse(DRIVER), None, None, jobs, compiler.builtins)
+	sections = {section.name: section for section in obj.sections}
+	assert '#bump' in [symbol for _, symbol in sections['twice'].relocations]
+	assert '#bump' in [symbol for _, symbol in sections['_global_'].relocations]
+
+	# the functions go first, behind the jump to the top level code
+	out_bytes = culevmpiler.link_objects([obj], 150)
+	header_size = 1 + 4
+	address = 150 + 6
+	section_addresses = {}
+	for section in obj.sections:
+		if section.name != '_global_':
+			section_addresses[section.name] = address
+			address += len(section.code)
+	section_addresses['_global_'] = address
+	for section in obj.sections:
+		for offset, symbol in section.relocations:
+			if symbol[1:] in section_addresses:
+				position = header_size + section_addresses[section.name] - 150 + offset
+				assert out_bytes[position:position + 4] == bytes(ctypes.c_int32(section_addresses[symbol[1:]]))
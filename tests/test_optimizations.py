@@ -0,0 +1,90 @@
+import glob
+import os
+
+import pytest
+
+import culevmpiler
+from asm_interpreter import run_assembly
+
+PROGRAMS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'programs', '*.fl')))
+
+
+# loops and element stores that are lowered to array copies, fills and joined LITERAL4_ARRAY stores
+LOWERED_STORES = '''table t( 1 s ):
+	int: n
+int src[6]
+int dst[6]
+float fa[8]
+float fb[4]
+int i
+src[0] = 7
+src[1] = 8
+src[2] = 9
+src[3] = 10
+for i in range(1, 3):
+	dst[i] = src[i]
+for i in range(2, 6):
+	fa[i] = 2
+fb[1] = 3
+fb[2] = 0.5
+fb[3] = 4
+fb[0] = 1
+dst[4] = 1
+dst[5] = src[2]
+n = i
+saveTable()
+'''
+
+
+def compile_unoptimized(compiler, text):
+	# the assembly as compile_branch leaves it, before assemble_program runs the passes
+	tree = compiler.parse(text)
+	symbol_table, function_signatures, tables = culevmpiler.build_symbol_table(tree, None, False, compiler.builtins)
+	state_token = culevmpiler.compile_state.set(culevmpiler.CompileState())
+	try:
+		assembly = culevmpiler.compile_branch(tree, symbol_table, function_signatures, '_global_')
+	finally:
+		culevmpiler.compile_state.reset(state_token)
+	header = 'TABLES ' + str(len(tables)) + '\n' + ''.join([str(table) for table in tables]) + '$_global_\n'
+	return header, assembly + 'NOP\n', symbol_table, tables
+
+
+def run_with_memory(compiler, assembly):
+	# the events and every variable left, with its type, so an int stored in a float array shows up
+	memory = {}
+	events = run_assembly(assembly, compiler.builtins, memory=memory)[0]
+	return events, {key: (type(value), value) for key, value in memory.items()}
+
+
+@pytest.mark.parametrize('text', [LOWERED_STORES] + [open(path).read() for path in PROGRAMS], ids=['lowered_stores'] + [os.path.basename(path) for path in PROGRAMS])
+def test_lowered_stores_keep_behaviour(compiler, monkeypatch, text):
+	lowered = run_with_memory(compiler, compiler.compile(text)[0])
+	# the same program with every store written element by element
+	monkeypatch.setattr(culevmpiler, 'compile_bulk_loop', lambda *args: None)
+	monkeypatch.setattr(culevmpiler, 'join_statements', lambda statements: ''.join([statement[2] for statement in statements]))
+	element_by_element = compiler.compile(text)[0]
+	assert 'LITERAL4_ARRAY' not in element_by_element
+	assert run_with_memory(compiler, element_by_element) == lowered
+
+
+@pytest.mark.parametrize('path', PROGRAMS, ids=os.path.basename)
+def test_redundant_loads_keep_behaviour(compiler, path):
+	header, assembly, _, _ = compile_unoptimized(compiler, open(path).read())
+	events, stack = run_assembly(header + assembly, compiler.builtins)
+	assert len(events) > 0
+	assert run_assembly(header + culevmpiler.eliminate_redundant_loads(assembly), compiler.builtins) == (events, stack)
+
+
+@pytest.mark.parametrize('path', PROGRAMS, ids=os.path.basename)
+def test_dead_stores_keep_behaviour(compiler, path):
+	header, assembly, symbol_table, tables = compile_unoptimized(compiler, open(path).read())
+	optimized = culevmpiler.eliminate_dead_stores(culevmpiler.eliminate_redundant_loads(assembly), symbol_table, tables)
+	assert run_assembly(header + optimized, compiler.builtins) == run_assembly(header + assembly, compiler.builtins)
+
+
+@pytest.mark.parametrize('path', PROGRAMS, ids=os.path.basename)
+def test_compiled_program_keeps_behaviour(compiler, path):
+	# the assembly that is shipped, with every pass of assemble_program
+	text = open(path).read()
+	header, assembly, _, _ = compile_unoptimized(compiler, text)
+	assert run_assembly(compiler.compile(text)[0], compiler.builtins) == run_assembly(header + assembly, compiler.builtins)
@@ -0,0 +1,110 @@
+import culevmpiler
+from asm_interpreter import run_assembly
+
+# a local of the caller with the name of the global the callee updates
+SHADOWED_GLOBAL = '''table t( 1 s ):
+	int: out
+int g
+void bump():
+	g += 1
+int work():
+	int g
+	g = 100
+	bump()
+	return g
+out = work()
+saveTable()
+out = g
+saveTable()
+'''
+
+NESTED_CALLS = '''table t( 1 s ):
+	int: out
+int g
+void bump():
+	g += 1
+void relay():
+	bump()
+int work():
+	int g
+	g = 100
+	relay()
+	return g
+out = work()
+saveTable()
+out = g
+saveTable()
+'''
+
+INLINED_CALL = '''table t( 1 s ):
+	int: out
+void bump():
+	out += 1
+int i
+for i in range(10):
+	bump()
+	saveTable()
+'''
+
+COLD_IF = '''table t( 1 s ):
+	int: n
+	int: k
+int i
+for i in range(10):
+	n += 1
+	if n > 8:
+		k += 5
+	saveTable()
+'''
+
+UNROLLED_LOOP = '''table t( 1 s ):
+	int: n
+	int: i
+for i in range(4):
+	n += i
+	saveTable()
+saveTable()
+'''
+
+
+def run_with_profile(compiler, text, line_hits):
+	# the events without and with the profile, and the changes the profile made
+	plain = run_assembly(compiler.compile(text)[0], compiler.builtins)
+	profile = culevmpiler.ExecutionProfile(line_hits)
+	profiled = run_assembly(compiler.compile(text, None, None, profile)[0], compiler.builtins)
+	return plain, profiled, profile.changes
+
+
+def test_inlined_body_keeps_its_globals(compiler):
+	plain, profiled, changes = run_with_profile(compiler, SHADOWED_GLOBAL, {1: 100})
+	assert plain[0] == [('SAVE_TABLE', (100,)), ('SAVE_TABLE', (1,))]
+	assert profiled == plain
+	assert not any('inlined' in change for change in changes)
+
+
+def test_nested_inlining_keeps_its_globals(compiler):
+	# relay has no locals, but bump would be pasted into work through it
+	plain, profiled, _ = run_with_profile(compiler, NESTED_CALLS, {1: 100})
+	assert plain[0] == [('SAVE_TABLE', (100,)), ('SAVE_TABLE', (1,))]
+	assert profiled == plain
+
+
+def test_hot_call_is_inlined(compiler):
+	plain, profiled, changes = run_with_profile(compiler, INLINED_CALL, {1: 100})
+	assert changes == ['Line 7: call to bump inlined']
+	assert profiled == plain
+
+
+def test_cold_if_body_moved_out_of_line(compiler):
+	plain, profiled, changes = run_with_profile(compiler, COLD_IF, {5: 10, 6: 10, 7: 10, 8: 1, 9: 10})
+	assert changes == ['Line 7: if body moved out of line']
+	assert profiled == plain
+	assert plain[0][-1] == ('SAVE_TABLE', (10, 10))
+
+
+def test_hot_loop_unrolled(compiler):
+	plain, profiled, changes = run_with_profile(compiler, UNROLLED_LOOP, {1: 100})
+	assert changes == ['Line 4: loop unrolled 4 times']
+	assert profiled == plain
+	# the loop variable is left at the end of the range, as the loop leaves it
+	assert plain[0][-1] == ('SAVE_TABLE', (6, 4))
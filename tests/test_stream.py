@@ -0,0 +1,92 @@
+import glob
+import io
+import os
+
+import pytest
+
+import culevmpiler
+from asm_interpreter import run_assembly
+
+PROGRAMS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'programs', '*.fl')))
+
+FORWARD_CALL = '''int g
+void a():
+	b()
+void b():
+	g += 1
+a()
+'''
+
+# the usual shape of a program: everything inside one while True
+MEASURE_LOOP = '''table test( 10 s ):
+	float: pot
+	float: temp
+float meas[2]
+int n
+while True:
+	waitNextMeasure()
+	SDI12SingleMeasurement(0,meas,2)
+	pot = meas[0]
+	temp = pot
+	n += 1
+	if n:
+		meas[0] = 1.5
+		meas[1] = 2
+	saveTable()
+'''
+
+# a store before a function is read after it, by the statements of the next chunk
+STORE_ACROSS_CHUNKS = '''table t( 1 s ):
+	int: out
+int g
+int h
+g = 3
+h = 1
+void bump():
+	h += 1
+bump()
+out = g + h
+saveTable()
+'''
+
+
+def compile_stream(compiler, text, assembly=False):
+	out_file = io.StringIO() if assembly else io.BytesIO()
+	compiler.compile_stream(text, out_file, assembly)
+	return out_file.getvalue()
+
+
+@pytest.mark.parametrize('text', [FORWARD_CALL, MEASURE_LOOP] + [open(path).read() for path in PROGRAMS],
+		ids=['forward_call', 'measure_loop'] + [os.path.basename(path) for path in PROGRAMS])
+def test_same_image_as_whole_program(compiler, text):
+	# every dead store of these programs is inside one chunk
+	assert compile_stream(compiler, text) == bytes(compiler.compile(text)[1])
+	assert compile_stream(compiler, text, True) == compiler.compile_treeless(text)[0]
+
+
+def test_store_read_in_next_chunk(compiler):
+	streamed = compile_stream(compiler, STORE_ACROSS_CHUNKS, True)
+	assert run_assembly(streamed, compiler.builtins)[0] == [('SAVE_TABLE', (5,))]
+
+
+def test_chunks_written_while_parsing(compiler, monkeypatch):
+	# every function is written once it is reduced, b waits for c, the function it calls. The chunks are
+	# told by the source position they start with
+	written = []
+
+	def feed(writer, assembly):
+		written.append((assembly.split('\n')[0], sorted(set(culevmpiler.compile_state.get().func_sig) - set(compiler.builtins))))
+	monkeypatch.setattr(culevmpiler.AsmStreamWriter, 'feed', feed)
+	compile_stream(compiler, '''int g
+void a():
+	g += 1
+void b():
+	c()
+void c():
+	g += 2
+void d():
+	a()
+b()
+''', True)
+	assert written == [('!2,1', ['a']), ('!4,1', ['a', 'b', 'c']), ('!6,1', ['a', 'b', 'c']), ('!8,1', ['a', 'b', 'c', 'd']),
+			('!10,1', ['a', 'b', 'c', 'd'])]
@@ -0,0 +1,79 @@
+import glob
+import os
+
+import pytest
+
+from asm_interpreter import run_assembly
+
+PROGRAMS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'programs', '*.fl')))
+
+FORWARD_CALL = '''table t( 1 s ):
+	float: g
+void a():
+	b(2)
+	saveTable()
+void b(float step):
+	g += step
+a()
+a()
+'''
+
+RECURSION = '''table t( 1 s ):
+	int: out
+int fact(int n):
+	if n < 2:
+		return 1
+	int m
+	m = n - 1
+	return n * fact(m)
+out = fact(5)
+saveTable()
+'''
+
+# the conditions and the returned value call functions that come later
+FORWARD_CONDITIONS = '''table t( 1 s ):
+	int: n
+	int: k
+int step():
+	while below(n, 4):
+		n += 1
+		if odd(n):
+			k += 1
+	return twice(k)
+n = step()
+saveTable()
+int below(int a, int b):
+	return b - a
+int odd(int a):
+	return a - a / 2 * 2
+int twice(int a):
+	return a * 2
+'''
+
+
+@pytest.mark.parametrize('path', PROGRAMS, ids=os.path.basename)
+def test_same_binary_as_parse_tree(compiler, path):
+	text = open(path).read()
+	# the labels are numbered in another order, the image is the same
+	assert compiler.compile_treeless(text)[1] == compiler.compile(text)[1]
+
+
+@pytest.mark.parametrize('text, events', [
+	(FORWARD_CALL, [('SAVE_TABLE', (2.0,)), ('SAVE_TABLE', (4.0,))]),
+	(RECURSION, [('SAVE_TABLE', (120,))]),
+	(FORWARD_CONDITIONS, [('SAVE_TABLE', (4, 2))]),
+], ids=['forward_call', 'recursion', 'forward_conditions'])
+def test_calls_before_definition(compiler, text, events):
+	asm, binary = compiler.compile_treeless(text)
+	assert binary == compiler.compile(text)[1]
+	assert run_assembly(asm, compiler.builtins)[0] == events
+
+
+def test_undefined_function(compiler):
+	with pytest.raises(Exception, match='Function c is not defined'):
+		compiler.compile_treeless('void a():\n\tc()\na()\n')
+
+
+def test_deferred_return_type_checked(compiler):
+	with pytest.raises(Exception, match='Function a should return value of type'):
+		compiler.compile_treeless('int a():\n\treturn b()\nfloat b():\n\treturn 1.5\n')
@@ -0,0 +1,40 @@
+import pytest
+
+import culevmpiler
+
+MEASURE_DELAY = '''table t( 10 s ):
+	int: n
+while True:
+	waitNextMeasure()
+	delay(DELAY_MS)
+	n += 1
+	saveTable()
+'''
+
+
+def wcet_report(compiler, text, clock_hz=1000000):
+	tree = compiler.parse(text)
+	paths, warnings, tables = culevmpiler.estimate_wcet(tree, None, None, clock_hz, compiler.builtins)
+	return paths, culevmpiler.wcet_report(paths, warnings, tables, clock_hz)
+
+
+@pytest.mark.parametrize('period, seconds', [('10 s', 10), ('60 s', 60), ('1 m', 60), ('2 m', 120), ('60 m', 3600),
+		('1 h', 3600), ('2 h', 7200), ('24 h', 86400)])
+def test_table_period_seconds(compiler, period, seconds):
+	_, _, tables = culevmpiler.build_symbol_table(compiler.parse('table t( ' + period + ' ):\n\tint: n\n'), None, False, compiler.builtins)
+	assert culevmpiler.table_period_seconds(tables[0].period) == seconds
+
+
+@pytest.mark.parametrize('clock_hz', [1000000, 8000000])
+def test_delay_overruns_table_period(compiler, clock_hz):
+	paths, report = wcet_report(compiler, MEASURE_DELAY.replace('DELAY_MS', '30000'), clock_hz)
+	periodic = [path for path in paths if path.periodic]
+	assert len(periodic) == 1
+	# the wait takes the same time at any clock
+	assert 30 < periodic[0].cycles / clock_hz < 30.01
+	assert 'can overrun the table period of 10 s' in report
+
+
+def test_delay_within_table_period(compiler):
+	_, report = wcet_report(compiler, MEASURE_DELAY.replace('DELAY_MS', '5000'))
+	assert 'WARNING' not in report